@@ -0,0 +1,273 @@
+r""" benchmark.py
+
+Times each stage of the render pipeline on a synthetic batch from
+sample_data.py, so changes can be measured without the LLPG database. The
+stages are fetching the UPRNs and records, laying out the cards' text,
+drawing the cards on to the sides, encoding and saving the JPEGs, and putting
+the JPEGs into PDFs. Each repeat starts with empty text caches, and the
+median time of each stage is reported, along with the peak memory of the
+process, which is its peak working set on Windows.
+
+The results are printed as a table and saved as JSON along with the commit
+they were measured on, so two runs can be compared:
+
+    python .\benchmark.py --sheets 50 --output before.json
+    python .\benchmark.py --sheets 50 --output after.json --compare before.json
+
+Everything is written to a temporary folder, so ./out isn't touched.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import PIL
+import generate_multi_image
+from generate_multi_image import (
+    AddressSide, AssetCache, CalendarSide, ConnectionPool, FONTS,
+    TextRenderer, build_cards, convert_to_pdf, get_uprns, sheet_tasks)
+from metrics import memory_sample
+from sample_data import (
+    FlakyConnection, connect_sample_database, create_sample_database)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['fetch', 'cards', 'sides', 'encode', 'pdf']
+
+
+def git_commit():
+    """ Returns the commit being measured and whether there are uncommitted
+    changes, or None if it isn't a git checkout
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout.strip()
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+def reset_caches():
+    """ Empties the text caches, so every repeat does the same work
+    """
+    generate_multi_image.TEXT = TextRenderer()
+
+def clear_output(work_dir):
+    """ Deletes the images and PDFs from the last repeat
+    """
+    shutil.rmtree(os.path.join(work_dir, 'out'))
+    os.mkdir(os.path.join(work_dir, 'out'))
+    for filename in os.listdir(work_dir):
+        if filename.endswith('-output.pdf'):
+            os.remove(os.path.join(work_dir, filename))
+
+def run_once(pool, sheets, pdf_pages, writers=0):
+    """ Runs the pipeline once over the first few sheets of the batch and
+    returns the seconds spent in each stage. With writer threads, the encode
+    stage is the time spent waiting for them, as the rest overlaps with
+    drawing the next sheets.
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+    start = time.perf_counter()
+    tasks = list(sheet_tasks(
+        itertools.islice(get_uprns(pool), sheets), pool))
+    timings['fetch'] = time.perf_counter() - start
+    with ThreadPoolExecutor(max(writers, 1)) as writer:
+        saving = deque()
+        for task in tasks:
+            start = time.perf_counter()
+            address_images, calendar_images = build_cards(
+                task.uprns, task.records)
+            timings['cards'] += time.perf_counter() - start
+            start = time.perf_counter()
+            sides = [AddressSide(address_images), CalendarSide(calendar_images)]
+            timings['sides'] += time.perf_counter() - start
+            start = time.perf_counter()
+            if writers:
+                saving.append([writer.submit(side.save) for side in sides])
+                while len(saving) > writers:
+                    for future in saving.popleft():
+                        future.result()
+            else:
+                for side in sides:
+                    side.save()
+            timings['encode'] += time.perf_counter() - start
+        start = time.perf_counter()
+        while saving:
+            for future in saving.popleft():
+                future.result()
+        timings['encode'] += time.perf_counter() - start
+    start = time.perf_counter()
+    convert_to_pdf(pdf_pages)
+    timings['pdf'] = time.perf_counter() - start
+    return len(tasks), timings
+
+def summarise(runs, sheet_count):
+    """ Works out the median time of each stage over all the repeats
+    """
+    stages = OrderedDict()
+    for stage in STAGES:
+        seconds = statistics.median(run[stage] for run in runs)
+        stages[stage] = {
+            'seconds': round(seconds, 4),
+            'ms_per_sheet': round(seconds * 1000 / max(sheet_count, 1), 2)}
+    total = sum(stage['seconds'] for stage in stages.values())
+    return stages, total
+
+def print_results(results, baseline=None):
+    """ Prints the time of each stage, and the change from a baseline if
+    there is one
+    """
+    print('{} sheets, {} repeat(s), commit {}'.format(
+        results['sheets'], results['repeat'], results['commit']))
+    header = '{:<8}{:>12}{:>14}'.format('stage', 'seconds', 'ms/sheet')
+    if baseline is not None:
+        header += '{:>12}{:>10}'.format('baseline', 'change')
+    print(header)
+    rows = [(stage, results['stages'][stage]['seconds'],
+             results['stages'][stage]['ms_per_sheet']) for stage in STAGES]
+    rows.append(('total', results['total_seconds'], None))
+    for stage, seconds, per_sheet in rows:
+        line = '{:<8}{:>12.3f}{:>14}'.format(
+            stage, seconds,
+            '' if per_sheet is None else '{:.1f}'.format(per_sheet))
+        if baseline is not None:
+            if stage == 'total':
+                base = baseline['total_seconds']
+            else:
+                base = baseline['stages'].get(stage, {}).get('seconds')
+            if base:
+                line += '{:>12.3f}{:>+9.1f}%'.format(
+                    base, (seconds - base) * 100 / base)
+        print(line)
+    print('{:.2f} sheets/s, peak RSS {}'.format(
+        results['sheets_per_second'],
+        'unknown' if results['peak_rss_mb'] is None
+        else '{:.0f} MB'.format(results['peak_rss_mb'])))
+
+def parse_args():
+    """ Reads the command line options
+    """
+    parser = argparse.ArgumentParser(
+        description='Times each stage of the render pipeline on a synthetic '
+                    'batch.')
+    parser.add_argument(
+        '--sheets', type=int, default=25,
+        help='number of sheets to render (default: 25)')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='number of times to run the pipeline (default: 3)')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='seed for the synthetic batch (default: 0)')
+    parser.add_argument(
+        '--schedules', type=int, default=36,
+        help='number of distinct collection schedules (default: 36)')
+    parser.add_argument(
+        '--pdf-pages', type=int, default=150,
+        help='most pages in each output PDF (default: 150)')
+    parser.add_argument(
+        '--writers', type=int, default=2,
+        help='number of threads saving the images while the next sheets are '
+             'drawn, or 0 to save each sheet before the next (default: 2)')
+    parser.add_argument(
+        '--band-height', type=int, default=None,
+        help='draw each side in bands of this many rows as it is saved, '
+             'which is timed as encoding and always done without writers')
+    parser.add_argument(
+        '--failure-rate', type=float, default=0,
+        help='chance of each database call failing, to time the retries '
+             '(default: 0)')
+    parser.add_argument(
+        '--output', default=None,
+        help='save the results as JSON to this file')
+    parser.add_argument(
+        '--compare', default=None,
+        help='a JSON file from an earlier run to compare the results with')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    WORK_DIR = tempfile.mkdtemp(prefix='address-cards-benchmark-')
+    START_DIR = os.getcwd()
+    DATABASE = os.path.join(WORK_DIR, 'sample.sqlite')
+    # A few properties are filtered out by uprn_query.sql, so make some spare
+    # to be sure there are enough sheets
+    create_sample_database(
+        DATABASE, count=ARGS.sheets * 4 + ARGS.sheets // 2 + 10,
+        seed=ARGS.seed, schedules=ARGS.schedules).close()
+    FAILURES = random.Random(ARGS.seed)
+    POOL = ConnectionPool(
+        lambda: FlakyConnection(
+            connect_sample_database(DATABASE), ARGS.failure_rate, FAILURES),
+        retries=20, backoff=0.01, max_backoff=0.1)
+    try:
+        for filename in ('cal_query.sql', 'uprn_query.sql'):
+            shutil.copy(os.path.join(REPO_DIR, filename), WORK_DIR)
+        os.mkdir(os.path.join(WORK_DIR, 'out'))
+        os.chdir(WORK_DIR)
+        generate_multi_image.ASSETS = AssetCache(os.path.join(REPO_DIR, 'in'))
+        generate_multi_image.OUTPUT = generate_multi_image.OUTPUT._replace(
+            band_height=ARGS.band_height)
+        START = time.perf_counter()
+        generate_multi_image.ASSETS.warm_up(FONTS)
+        SETUP = time.perf_counter() - START
+        RUNS = []
+        for _ in range(ARGS.repeat):
+            reset_caches()
+            clear_output(WORK_DIR)
+            SHEET_COUNT, TIMINGS = run_once(
+                POOL, ARGS.sheets, ARGS.pdf_pages,
+                0 if ARGS.band_height else ARGS.writers)
+            RUNS.append(TIMINGS)
+    finally:
+        os.chdir(START_DIR)
+        POOL.close()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    STAGE_RESULTS, TOTAL = summarise(RUNS, SHEET_COUNT)
+    COMMIT, DIRTY = git_commit()
+    RESULTS = {
+        'commit': COMMIT,
+        'dirty': DIRTY,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'sheets': SHEET_COUNT,
+        'repeat': ARGS.repeat,
+        'seed': ARGS.seed,
+        'schedules': ARGS.schedules,
+        'writers': 0 if ARGS.band_height else ARGS.writers,
+        'band_height': ARGS.band_height,
+        'failure_rate': ARGS.failure_rate,
+        'db_retries': POOL.retry_count,
+        'setup_seconds': round(SETUP, 4),
+        'stages': STAGE_RESULTS,
+        'total_seconds': round(TOTAL, 4),
+        'sheets_per_second': round(SHEET_COUNT / max(TOTAL, 1e-9), 3),
+        # The peak working set on Windows
+        'peak_rss_mb': memory_sample().get('peak_rss_mb'),
+        'runs': [{stage: round(run[stage], 4) for stage in STAGES}
+                 for run in RUNS]}
+    BASELINE = None
+    if ARGS.compare is not None:
+        with open(ARGS.compare) as baseline_file:
+            BASELINE = json.load(baseline_file)
+    print_results(RESULTS, BASELINE)
+    if ARGS.output is not None:
+        with open(ARGS.output, 'w') as results_file:
+            json.dump(RESULTS, results_file, indent=2)
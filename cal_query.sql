@@ -1,6 +1,6 @@
 SELECT
-    p.uprn,
-    REPLACE(REPLACE(l.ADDRESS_BLOCK_ORG, 'North Yorkshire' + CHAR(13) + CHAR(10), ''), CHAR(13) + CHAR(10), '<br>') AS addressBlock,
+    p.uprn AS uprn,
+    l.ADDRESS_BLOCK_ORG AS addressBlock,
         CASE
             WHEN ref.ScheduleDayID < 8 then 0
             WHEN ref.ScheduleDayID > 7 then 1
@@ -56,4 +56,4 @@ FROM properties p
     LEFT JOIN (SELECT * FROM rounds WHERE serviceid = 'GW' AND RoundEra = 2) gw
         ON psr_gw.RoundID = gw.RoundID
 WHERE psr_ref.RoundEra = 2
-AND p.uprn IN (?)
+AND p.uprn IN ({})
@@ -0,0 +1,47 @@
+r"""
+Saves the UPRNs in a batch and their address and collection data from the
+database to a SQLite snapshot, so the batch can be rendered again, reprinted
+or tested without the database or the network:
+
+    python .\export_snapshot.py .\batch4.sqlite
+    python .\generate_multi_image.py --snapshot .\batch4.sqlite
+
+The UPRNs are selected by uprn_query.sql, or read from a CSV file with
+--uprn-file, and kept in the same order. The snapshot is read with
+snapshot_uprn_query.sql and snapshot_cal_query.sql.
+"""
+
+import argparse
+import time
+
+import pyodbc
+
+from generate_multi_image import (
+    ConnectionPool, ConnectionString, connect, iter_uprns, read_uprns,
+    write_snapshot)
+
+parser = argparse.ArgumentParser(
+    description='Saves a batch from the database to a SQLite snapshot.')
+parser.add_argument('path', help='the snapshot file to write')
+parser.add_argument(
+    '--uprn-file', default=None,
+    help='read the UPRNs from the first column of a CSV file instead of '
+         'running uprn_query.sql')
+parser.add_argument(
+    '--db-retries', type=int, default=5,
+    help='times to retry a query on a new connection if the database drops '
+         '(default: 5)')
+args = parser.parse_args()
+pyodbc.pooling = False
+conn_string = ConnectionString()
+pool = ConnectionPool(
+    lambda: connect(conn_string), size=2, retries=args.db_retries)
+start = time.time()
+if args.uprn_file is None:
+    uprns = iter_uprns(pool)
+else:
+    uprns = read_uprns(args.uprn_file)
+uprn_count, record_count = write_snapshot(pool, uprns, args.path)
+pool.close()
+print('Saved {} UPRNs and {} records to {} in {:.1f}s'.format(
+    uprn_count, record_count, args.path, time.time() - start))
@@ -4,7 +4,7 @@ Generates some postcards about bin collection data using data from the Local Lan
 
 ## How to run
 
-The program doesn't take any command line arguments, so it can be run however you would run a Python 3 script:
+The program can be run however you would run a Python 3 script, and with no options it behaves the same as it always has:
 
 If Python 3 is the only environment installed:
 
@@ -16,14 +16,39 @@ If Python 2 is installed as well and you're using some variant of the Windows la
 
 * `py -3 .\generate_multi_image.py`
 
+## Options
+
+Run `python .\generate_multi_image.py --help` for the full list.
+
+* `--workers N` renders sheets in N worker processes at once. Sheets are still saved, logged and put in the PDFs in the same order, and a sheet that fails is logged and skipped rather than stopping the run. If a worker process dies, say killed for running out of memory, the pool is started again and the sheets it lost are rendered again one at a time, so only a sheet that kills a worker twice is failed. The time taken and sheets per second are printed at the end, so the speedup can be compared against `--workers 1` (the default).
+* `--pdf-pages N` and `--pdf-max-mb N` set when a new output PDF is started, by page count (150 by default) or by file size. Files are only ever split between an address side and its calendar side.
+* `--spool-pdf` puts each sheet into the output PDFs as soon as both its sides are saved, instead of all at the end, so the first file can go to the printer a few minutes into a run of several hours. Each file is written as `N-output.pdf.part` and renamed to `N-output.pdf` once it's full, so any file with its final name is complete and won't change. The files come out exactly the same as without it. With `--resume` the sheets from the earlier run are put in as they're reached, so the files are rewritten in order, and a `.part` file left by a run that stopped can be deleted. It doesn't work with `--shard` or `--proof-scale`, and `--output vector` always writes its files this way.
+* `--uprn-file FILE` reads the UPRNs from the first column of a CSV or text file instead of running uprn_query.sql.
+* `--snapshot FILE` renders the batch from a snapshot instead of the database. `python .\export_snapshot.py FILE` saves the UPRNs selected by uprn_query.sql (or `--uprn-file`), in order, and their address and collection data to a SQLite file, keyed by UPRN, in a few seconds. Re-runs and reprints of the batch can then be done from the snapshot on any machine, without the database or the network, and it's read with snapshot_uprn_query.sql and snapshot_cal_query.sql, which need to be next to it the same as the other queries. The sheets come out exactly the same, so `--resume` reuses images rendered from the database and the other way round.
+* `--shard K/N` splits the batch between N machines or processes and renders only the Kth share. The sheets are numbered the same as for the whole batch and dealt out in turn, so shard 1 of 3 gets sheets 1, 4, 7 and so on. Each shard saves its images and journal to its own folder, `./out/shard-K-of-N`, and writes a list of them, `shard.json`, when it finishes. Once every shard has finished, `merge_shards.py` puts all their images into PDFs in the same order and split the same way as a run of the whole batch, either from the shard folders in ./out or from folders copied from other machines. To try it on one machine, start `python .\generate_multi_image.py --shard 1/2` and `python .\generate_multi_image.py --shard 2/2` in two windows, then run `python .\merge_shards.py`. Every shard reads the whole batch from the database, so don't change the data while they run.
+* `--preflight` checks the data for every UPRN in the batch before anything is rendered, which takes seconds rather than hours. The records are loaded a thousand at a time and each UPRN is rejected if it has no record, no address, or a refuse or recycling collection day or week that is NULL or out of range, or if its address or calendar strings don't fit in their text boxes. Every problem is written to `./out/rejects.csv` with the UPRN, the field, its value and what's wrong, and the rejected UPRNs are left out of the run so they can be fixed and printed later. `--preflight-only` writes the report without rendering anything, and exits with status 1 if anything was rejected.
+* `--resume` carries on a run that stopped part way through, or re-runs a batch after some of its data has changed. Every sheet's UPRNs, status and image paths are kept in a journal, `./out/journal.sqlite`, along with a hash of everything the sheet is made from: its UPRNs, their address and collection data, the template and font files and `LAYOUT_VERSION`. A sheet with the same hash as one the journal has images for is reused, if the images are still there, so only the sheets that have changed are rendered again. The summary at the end counts the reused sheets apart from the rendered ones, and the sheets per second only counts the rendered ones. Without `--resume` the journal is started again. Change `LAYOUT_VERSION` in generate_multi_image.py whenever a change to the code changes how the sheets look. `get_lost_uprns.py` lists the UPRNs that haven't been printed from the journal, optionally checking them against a CSV of the whole batch.
+* A progress line is printed every 30 seconds with the number of sheets done out of the total, the sheets per second, the estimated time left, how long ago the last sheet finished and the memory in use, so a run that has stalled is easy to spot. `--progress-interval N` changes how often, and 0 turns it off. The time spent in each stage (database queries, text boxes, cards, composing the sheets, saving and PDFs) is printed at the end, and `--metrics-log FILE` appends the progress and stage times to a JSON lines file to graph after the run. `--trace-memory` adds the Python memory allocations traced by tracemalloc, which slows the run down.
+* `--proof-scale S` renders a quick proof of the whole batch at S times the print resolution, e.g. `--proof-scale 0.25` for a quarter size. The templates, fonts, card positions and text boxes are all scaled together, so the proof looks the same as the print, just smaller. The images are saved at a lower JPEG quality to `./proof`, which has its own journal, and instead of the print PDFs `./proof/proof.pdf` is written as a contact sheet with both sides of three sheets on each A3 page, labelled with their UPRNs, to check the whole batch by eye before the full run.
+* `--band-height N` draws each side in bands of N rows (256 is a good size) instead of as one 60 MB image. Each band is drawn with only the cards that cross it and written to a memory mapped file next to the images, and the JPEG is saved straight from the file, so the operating system can page the finished bands out to disk. The JPEG's Huffman tables aren't optimised in this mode, because the encoder would have to hold the whole image to do it, so the files are about 15% bigger but the pictures are exactly the same. The memory a sheet needs no longer depends on the sheet size, so more `--workers` fit on a machine; the decoded templates are still held once per process. The sides are saved as they're drawn, so `--writers` isn't used.
+* `--output vector` skips the JPEGs and writes the PDFs directly. Each template image is put in each PDF once and shared by every page, and the addresses, calendar strings, index and UPRN are written as real text in the same fonts, positions and rotations as the JPEG cards, so it's much faster and the files are much smaller. The fonts need to be TrueType files, and they're embedded in each PDF with the Windows (cp1252) character set, so any other character prints as a question mark; each one is logged as a warning, and `--preflight` with `--output vector` rejects the UPRN. The PDFs are written in one process without rendering any images, so it can't be used with `--workers`, `--writers` or `--band-height`.
+
+## Benchmarking
+
+`benchmark.py` times each stage of the pipeline (fetching the data, laying out the cards, drawing them on to the sides, saving the JPEGs and making the PDFs) on a synthetic batch, so it can be run anywhere without the LLPG database. `sample_data.py` makes the batch: a SQLite database with the same tables the SQL queries read, filled with made-up addresses and a few dozen collection schedules, and the same seed always gives the same batch. `--writers N` sets the number of threads saving the images, as in the renderer, and 0 saves each sheet before drawing the next; with writers the encode time is only the time spent waiting for them. `--failure-rate` makes database calls fail at random, to check how much the retries cost. The results are printed with the sheets per second and peak memory (the peak working set on Windows, and the peak resident set elsewhere), and `--output` saves them as JSON along with the commit, so runs on different commits can be compared with `--compare`:
+
+* `python .\benchmark.py --sheets 50 --output before.json`
+
+* `python .\benchmark.py --sheets 50 --compare before.json`
+
 ## How it works
 
-1. get_uprns() returns a list of Unique Property Reference Numbers (UPRNs) used to identify each property that bins are collected from.
-2. The list of UPRNs is split into sublists of four UPRNs each, because the generated postcards are four A5 cards in a grid on an A3 (or SRA3) sheet.
-3. For each single UPRN in a list of four, a Calendar object and an Address object are created. A Calendar object contains the data for when the bins are collected, and the Address object contains the address data for the property.
-4. A CalendarImage object and AddressImage object are created using the Calendar and Address objects. The attributes calendar_image and address_image are PIL.Image types from the Pillow imaging library. The attributes calendar and address are the parent Calendar and Address objects. This creates a list of four CalendarImages and four AddressImages.
-5. The eight images are arranged in a grid into a CalendarSide and an AddressSide themselves being PIL.Image tyoes, which are saved as two separate JPEG images.
-6. The images are converted into PDFs and merged together into groups of 150.
+1. get_uprns() streams the Unique Property Reference Numbers (UPRNs) used to identify each property that bins are collected from, fetching them from the database a thousand at a time. `--uprn-file` reads them from the first column of a CSV file instead.
+2. The UPRNs are split into lists of four as they're read, because the generated postcards are four A5 cards in a grid on an A3 (or SRA3) sheet. If the last sheet isn't full it's padded with blank cards, so no UPRNs are left out, and only a chunk of sheets is held in memory at a time however big the batch is.
+3. The calendar and address data is fetched by a RecordStore for each chunk of 250 sheets, which sends all 1000 UPRNs to the database in one query rather than two queries per UPRN. The records for the next chunk are fetched on a background thread while the current chunk is rendered, so waiting on the database overlaps with drawing the cards (`--prefetch N` fetches N chunks ahead). The connections come from a small pool, and if the database drops, a query is tried again on a new connection, waiting twice as long each time up to `--db-retries` times; the UPRN stream picks up from where it was. For each single UPRN in a list of four, a Calendar object and an Address object are built from the RecordStore. A Calendar object contains the data for when the bins are collected, and the Address object contains the address data for the property.
+4. A CalendarImage object and AddressImage object are created using the Calendar and Address objects. Each one names a layout in CARD_LAYOUTS and fills in its values: the calendar strings or the address, and the index and UPRN. A layout lists the template and, for each field, the box, font, rotation, colour and wrap width; the AssetCache compiles each one into a CardLayout the first time it is used, with the boxes scaled to the template and the fonts loaded, so a card only has to wrap its text into the compiled slots. The attributes calendar and address are the parent Calendar and Address objects. This creates a list of four CalendarImages and four AddressImages. The template images and fonts are decoded and loaded once at startup by the AssetCache. Text is drawn by a TextRenderer, which caches line measurements, rendered lines and finished (already rotated) text boxes, keyed by the text and its box, so a calendar string shared by many properties, as it is by everyone on the same rounds, is only drawn once.
+5. A CalendarSide and an AddressSide, themselves PIL.Image types from the Pillow imaging library, are made from a copy of the blank sheet. Each card is drawn straight on to the sheet at its place in the grid: its template is pasted and its text is filled on in a solid colour through the mask, clipped to the card. No separate image of each card is made, so each sheet only needs one full-size image per side. The two sides are saved as two separate JPEG images by a pool of writer threads (`--writers N`, 2 by default), so the next sheet is drawn while the last one is encoded, which Pillow does without holding the GIL. Only one sheet per writer is left waiting to be saved before drawing waits for the oldest, so memory use stays bounded. Each image is written to a `.tmp` file and renamed once it's complete, so a crash never leaves half an image in ./out, and a sheet is only marked done in the journal once both its images are saved. With `--workers` above 1 each worker process saves its own sheets instead.
+6. The images from the run are put into PDFs in groups of 150 pages, in the same order as the sheets, so old images left in ./out aren't included. Each JPEG is copied into the PDF as it is, without being decoded, and pages are written one at a time, so memory use stays the same whatever the group size. With `--spool-pdf` this is done as each sheet is finished rather than at the end.
 
 ## Notes for the future
 
@@ -31,19 +56,39 @@ Assuming the data follows the same format as these SQL queries, this program sho
 
 * This was written in Python 3.6.4 using Pillow 5.0.0. It won't work on Python 2, but should be simple enough to work on any future versions.
 * The centring of text on the bins is _really_ awkward. Pillow has no concept of centre-aligning text, so each string has to be split into separate lines using textwrap.wrap(), and the width of each line needs to be calculated so the text can be placed relative to each other so it's 'centred'. The string splits nicely into lines of 7 characters, but if the string changes in the future, this value might have to change.
-* The program takes about five hours to process 5000 UPRNs and doesn't handle crashes gracefully. Crashes can be caused by unexpected NULLs in the SQL results or by the SQL server itself going down, as well as anything happening locally on the machine running it. Leave plenty of time spare to produce things.
+* The program takes about five hours to process 5000 UPRNs and doesn't handle crashes gracefully. Crashes can be caused by unexpected NULLs in the SQL results or by the SQL server itself going down, as well as anything happening locally on the machine running it. Run with `--preflight-only` first to find bad rows in seconds. Leave plenty of time spare to produce things. If it does stop, run it again with `--resume` to carry on from the last finished sheet; uprn_query.sql orders the UPRNs so the sheets come out the same every time.
 * The template images may need to be converted from the CMYK colour space to RGB if the colours look too bright. A good place to do this is here https://www.cmyk2rgb.com/
-* This could be a lot more nicely object-oriented, but as it stands, CalendarSide and AddressSide are annoyingly separate. Any changes that need to be made to both sides will need to be made in both sides.
-* This doesn't generate different images for properties that have their recycling bins and glass recycling bins collected on different days. This may be needed for a later batch. Some of the very basic templates are there, but don't actually do anything.
+* CalendarSide and AddressSide share SheetSide, so a change to how a side is drawn or saved only needs making once. A new kind of card is a new entry in CARD_LAYOUTS rather than new drawing code.
+* This doesn't generate different images for properties that have their recycling bins and glass recycling bins collected on different days. This may be needed for a later batch. Calendar.image_type picks out those properties as DIFFERENT_COLLECTION, but there's no template for them yet, so their sheets fail (and `--preflight` rejects them) rather than printing the wrong dates. Once there is a template, add it to CARD_LAYOUTS with its measured text boxes. cal_query.sql doesn't read a separate day for the box either, so it gives the box the recycling day and every property is SAME_COLLECTION for now.
 * Powershell sometimes gets stuck while running it. I don't know why, and it's not great, so you'll have to keep an eye on it and tap a key to get it running again.
 """
 
+import argparse
+import csv
+import functools
+import hashlib
 import json
+import math
+import mmap
+import queue
+import random
+import re
 import textwrap
 import os
-import gc
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-import pyodbc
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor)
+from concurrent.futures.process import BrokenProcessPool
+from urllib.request import pathname2url
+from PIL import Image, ImageDraw, ImageFont
+from metrics import METRICS, ProgressReporter
+from pdf_writer import PdfWriter, pdf_number, pdf_string, read_image_size
 
 class ConnectionString:
     """ Represents a pyodbc connection string
@@ -61,11 +106,820 @@ class ConnectionString:
             self.pwd = config['pwd']
 
 
+SHEET_TEMPLATE = 'blank_sra3.jpg'
+CALENDAR_TEMPLATE = 'postcard-back-same-dates.jpg'
+ADDRESS_TEMPLATE = 'postcard-front.jpg'
+# X and Y offsets for top-left, top-right, bottom-left, bottom-right
+CARD_POSITIONS = [(82, 47), (2657, 47), (82, 1890), (2657, 1890)]
+# Change this whenever a change to the code changes how the sheets look, so
+# sheets rendered by the old code aren't reused
+LAYOUT_VERSION = 1
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+# Where the sheet images are saved, their JPEG quality and resolution, and
+# the height of the bands they're drawn in, or None to draw each side whole.
+# Proofs are saved somewhere else at a lower resolution.
+OutputSettings = namedtuple(
+    'OutputSettings', ['out_dir', 'quality', 'dpi', 'band_height'])
+OUTPUT = OutputSettings('./out', 95, 300, None)
+# Whether this worker process has loaded the templates and fonts yet
+WORKER_READY = False
+
+# The SQL files that select the UPRNs in the batch and load their records. A
+# snapshot made by export_snapshot.py is read with its own queries.
+QueryFiles = namedtuple('QueryFiles', ['uprns', 'records'])
+QUERIES = QueryFiles('./uprn_query.sql', './cal_query.sql')
+SNAPSHOT_QUERIES = QueryFiles(
+    './snapshot_uprn_query.sql', './snapshot_cal_query.sql')
+
+# A piece of text on a card. text is a list of lines to centre for calendar
+# strings, or a string with its own line breaks when multiline is True.
+TextSlot = namedtuple('TextSlot', [
+    'text', 'width', 'height', 'rotation', 'font', 'x', 'y', 'rgb',
+    'multiline'])
+
+# Where a piece of text goes in a card layout: the card's value it shows, the
+# width, height and rotation of its box, the font file and size, the X and Y
+# coordinate of the box on the card at 300 dpi, its colour, and how many
+# characters to wrap it at and centre each line, or None to keep its own line
+# breaks
+SlotSpec = namedtuple('SlotSpec', [
+    'field', 'width', 'height', 'rotation', 'font', 'size', 'x', 'y', 'rgb',
+    'wrap'])
+
+# The index and UPRN printed on both sides of a card, which keep track of
+# corresponding addresses and calendars
+INDEX_SLOTS = [
+    SlotSpec('index', 100, 100, 0, 'consola.ttf', 40, 0, 0, BLACK, None),
+    SlotSpec('uprn', 1000, 100, 0, 'consola.ttf', 40, 750, 0, BLACK, None)]
+
+# The template and text of each kind of card. A calendar card is drawn with
+# the layout named by Calendar.image_type. Layouts are compiled by the
+# AssetCache for the resolution being rendered, so a new kind of card only
+# needs a new entry here.
+CARD_LAYOUTS = {
+    'ADDRESS': (ADDRESS_TEMPLATE, [
+        SlotSpec('address', 1900, 850, 0, 'arial.ttf', 45, 500, 700, BLACK,
+                 None)] + INDEX_SLOTS),
+    # The recycling bin and box are collected together, so the box has no
+    # date of its own
+    'SAME_COLLECTION': (CALENDAR_TEMPLATE, [
+        SlotSpec('black_bin', 300, 450, 4,
+                 'futura bold condensed italic bt.ttf', 59, 380, 710, WHITE, 7),
+        SlotSpec('recycling_bin', 300, 450, 4,
+                 'futura bold condensed italic bt.ttf', 59, 1070, 710, WHITE,
+                 7),
+        SlotSpec('green_bin', 300, 450, 4,
+                 'futura bold condensed italic bt.ttf', 59, 1975, 710, WHITE,
+                 7)] + INDEX_SLOTS)}
+
+# Fonts used on the cards, loaded up front by AssetCache.warm_up()
+FONTS = sorted(set(
+    (spec.font, spec.size)
+    for _, specs in CARD_LAYOUTS.values() for spec in specs))
+
+
+class AssetCache:
+    """ Decodes each template image and loads each font once per process, and
+    hands out copies of the templates to be drawn on. Everything is laid out
+    in pixels at 300 dpi, and a scale below 1 shrinks the templates, fonts
+    and coordinates to render proofs at a lower resolution.
+    """
+
+    def __init__(self, template_dir='./in', scale=1):
+        """ Sets up the empty caches and the hit/miss counters
+        """
+        self.template_dir = template_dir
+        self.scale = scale
+        self.templates = {}
+        self.fonts = {}
+        self.layouts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load_template(self, filename):
+        """ Returns the shared decoded template, decoding it on first use
+        """
+        image = self.templates.get(filename)
+        if image is None:
+            self.misses += 1
+            image = Image.open(
+                os.path.join(self.template_dir, filename)).convert('RGB')
+            image.load()
+            if self.scale != 1:
+                image = image.resize(
+                    (self.scaled(image.size[0]), self.scaled(image.size[1])),
+                    Image.LANCZOS)
+            self.templates[filename] = image
+        else:
+            self.hits += 1
+        return image
+
+    def template(self, filename):
+        """ Returns a copy of a template that is safe to draw on
+        """
+        return self.load_template(filename).copy()
+
+    def font(self, filename, size):
+        """ Returns a shared font, loading it on first use
+        """
+        font = self.fonts.get((filename, size))
+        if font is None:
+            self.misses += 1
+            font = ImageFont.truetype(filename, max(self.scaled(size), 1))
+            self.fonts[(filename, size)] = font
+        else:
+            self.hits += 1
+        return font
+
+    def layout(self, name):
+        """ Returns one of the CARD_LAYOUTS compiled for this resolution,
+        compiling it on first use
+        """
+        layout = self.layouts.get(name)
+        if layout is None:
+            template, specs = CARD_LAYOUTS[name]
+            layout = CardLayout(self, template, specs)
+            self.layouts[name] = layout
+        return layout
+
+    def scaled(self, value):
+        """ Scales a size or coordinate in pixels at 300 dpi to the resolution
+        being rendered
+        """
+        return int(round(value * self.scale))
+
+    def warm_up(self, fonts):
+        """ Decodes every template in the template folder, loads the given
+        fonts and compiles the card layouts so the first cards don't pay for
+        it
+        """
+        for filename in sorted(os.listdir(self.template_dir)):
+            if filename.lower().endswith('.jpg'):
+                self.load_template(filename)
+        for filename, size in fonts:
+            self.font(filename, size)
+        for name in CARD_LAYOUTS:
+            self.layout(name)
+
+    def stats(self):
+        """ Returns the cache counters as a string for logging
+        """
+        return 'Assets: {} templates, {} fonts, {} hits, {} misses'.format(
+            len(self.templates), len(self.fonts), self.hits, self.misses)
+
+
+ASSETS = AssetCache()
+
+
+class CardLayout:
+    """ A card layout compiled into a plan for drawing it: the template and
+    its size, and the text slots with their fonts loaded and their boxes
+    scaled. Only the text is left to fill in for each card.
+    """
+
+    def __init__(self, assets, template, specs):
+        """ Works out everything about the layout that doesn't depend on the
+        card's values
+        """
+        self.template = template
+        self.size = assets.load_template(template).size
+        self.fields = [spec.field for spec in specs]
+        self.wraps = [spec.wrap for spec in specs]
+        self.slots = [
+            TextSlot(
+                None, assets.scaled(spec.width), assets.scaled(spec.height),
+                spec.rotation, assets.font(spec.font, spec.size),
+                assets.scaled(spec.x), assets.scaled(spec.y), spec.rgb,
+                spec.wrap is None)
+            for spec in specs]
+
+    def fill(self, values):
+        """ Returns the text slots for a card, given a dictionary of the
+        values of its fields
+        """
+        return [
+            slot._replace(text=values[field] if wrap is None
+                          else wrap_text(values[field], wrap))
+            for field, wrap, slot in zip(self.fields, self.wraps, self.slots)]
+
+
+class LRUCache:
+    """ Holds up to a fixed number of items, dropping the least recently used
+    item when it's full, and counts hits and misses
+    """
+
+    def __init__(self, maxsize):
+        """ Sets up the empty cache and the hit/miss counters
+        """
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the item for a key, or None if it isn't cached
+        """
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """ Adds an item, dropping the oldest one if the cache is full
+        """
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def stats(self, name):
+        """ Returns the cache counters as a string for logging
+        """
+        return '{}: {}/{} items, {} hits, {} misses'.format(
+            name, len(self.items), self.maxsize, self.hits, self.misses)
+
+
+
+class TextRenderer:
+    """ Lays out and rasterises text boxes. Line measurements, rendered lines
+    and finished text boxes are cached, so a string that has been drawn before
+    costs a lookup instead of another draw and rotate.
+    """
+
+    def __init__(self, metric_cache_size=4096, run_cache_size=2048,
+                 box_cache_size=256):
+        """ Sets up the caches and a small image to measure text with
+        """
+        self.metrics = LRUCache(metric_cache_size)
+        self.runs = LRUCache(run_cache_size)
+        self.boxes = LRUCache(box_cache_size)
+        self.measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+    def line_size(self, line, font):
+        """ Returns the width and height of a single line of text
+        """
+        key = (font.path, font.size, line)
+        size = self.metrics.get(key)
+        if size is None:
+            if hasattr(self.measure, 'textbbox'):
+                size = tuple(self.measure.textbbox((0, 0), line, font=font)[2:])
+            else:
+                size = self.measure.textsize(line, font=font)
+            self.metrics.put(key, size)
+        return size
+
+    def glyph_run(self, line, font):
+        """ Returns a single line of text rendered as a mask
+        """
+        key = (font.path, font.size, line)
+        run = self.runs.get(key)
+        if run is None:
+            run = Image.new('L', self.line_size(line, font))
+            ImageDraw.Draw(run).text((0, 0), line, font=font, fill=255)
+            self.runs.put(key, run)
+        return run
+
+    @METRICS.timed('text_box')
+    def text_box(self, string, width, height, rotation, font, multiline):
+        """ Returns a rotated mask of some text laid out in a box
+        """
+        # If the string doesn't have built-in linebreaks (i.e. calendar string)
+        if not multiline:
+            # Calendar strings repeat across the batch, so keep the whole box
+            key = (font.path, font.size, tuple(string), width, height, rotation)
+            text_box = self.boxes.get(key)
+            if text_box is None:
+                text_box = self.centred_box(string, width, height, font)
+                if rotation:
+                    text_box = text_box.rotate(
+                        rotation, resample=Image.BICUBIC, expand=True)
+                self.boxes.put(key, text_box)
+            return text_box
+        # Addresses are all different but made of common lines, so the box is
+        # put together from cached lines
+        text_box = Image.new('L', (width, height))
+        text_box_draw = ImageDraw.Draw(text_box)
+        for x_coord, y_coord, line in self.layout(string, width, font, True):
+            text_box_draw.bitmap(
+                (x_coord, y_coord), self.glyph_run(line, font), fill=255)
+        if rotation:
+            text_box = text_box.rotate(
+                rotation, resample=Image.BICUBIC, expand=True)
+        return text_box
+
+    def layout(self, string, width, font, multiline):
+        """ Returns the position of each line of some text in its box, as a
+        list of (x, y, line), with y at the top of the line
+        """
+        # Built-in linebreaks are spaced the same as Pillow's multiline_text()
+        if multiline:
+            line_spacing = self.line_size('A', font)[1] + ASSETS.scaled(20)
+            return [(0, number * line_spacing, line)
+                    for number, line in enumerate(string.split('\n'))]
+        positions = []
+        padding = ASSETS.scaled(10)
+        current_height = ASSETS.scaled(50)
+        for line in string:
+            line_width, line_height = self.line_size(line, font)
+            # Places the text in the box so it's centre aligned
+            positions.append(((width - line_width) / 2, current_height, line))
+            current_height += line_height + padding
+        return positions
+
+    def centred_box(self, lines, width, height, font):
+        """ Draws a list of lines in a box, centring each one
+        """
+        text_box = Image.new('L', (width, height))
+        text_box_draw = ImageDraw.Draw(text_box)
+        for x_coord, y_coord, line in self.layout(lines, width, font, False):
+            text_box_draw.text((x_coord, y_coord), line, font=font, fill=255)
+        return text_box
+
+    def stats(self):
+        """ Returns the cache counters as a string for logging
+        """
+        return '\n'.join([
+            self.metrics.stats('Text metrics'),
+            self.runs.stats('Text lines'),
+            self.boxes.stats('Text boxes')])
+
+
+TEXT = TextRenderer()
+
+
+# A sheet to render. done holds the paths of its images if an earlier run
+# already finished it.
+SheetTask = namedtuple('SheetTask', ['index', 'uprns', 'records', 'done'])
+
+# One row of cal_query.sql, holding both the calendar and address data
+Record = namedtuple('Record', [
+    'uprn', 'addressBlock',
+    'REFWeek', 'REFDay',
+    'RECYWeek', 'RECYDay',
+    'GWWeek', 'GWDay'])
+
+# The tables in a snapshot of a batch: the UPRNs in order and their records
+SNAPSHOT_SCHEMA = '''
+CREATE TABLE batch (
+    seq INTEGER PRIMARY KEY,
+    uprn TEXT NOT NULL);
+CREATE TABLE records (
+    uprn TEXT PRIMARY KEY,
+    addressBlock TEXT,
+    REFWeek INTEGER,
+    REFDay TEXT,
+    RECYWeek INTEGER,
+    RECYDay TEXT,
+    GWWeek INTEGER,
+    GWDay TEXT) WITHOUT ROWID;
+CREATE TABLE snapshot (
+    created TEXT NOT NULL,
+    uprn_count INTEGER NOT NULL,
+    record_count INTEGER NOT NULL);'''
+
+# A problem found with a UPRN's data by the preflight checks, as written to
+# the rejects report
+Reject = namedtuple('Reject', ['uprn', 'field', 'value', 'problem'])
+
+# The collection days cal_query.sql can return, and the services that every
+# property must have a day for, as (day column, week column, required)
+COLLECTION_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+SERVICE_COLUMNS = [
+    ('REFDay', 'REFWeek', True),
+    ('RECYDay', 'RECYWeek', True),
+    ('GWDay', 'GWWeek', False)]
+
+
+class RecordStore:
+    """ Holds the calendar and address data for a batch of UPRNs, keyed by
+    UPRN, so cards can be built without going back to the database
+    """
+
+    def __init__(self, chunk_size=1000):
+        """ Reads the query and sets how many UPRNs are sent to the database
+        at once. SQL Server allows at most 2100 parameters in a statement.
+        """
+        self.chunk_size = chunk_size
+        self.records = {}
+        with open(QUERIES.records, 'r') as query_file:
+            self.query = query_file.read()
+
+    def __contains__(self, uprn):
+        return uprn in self.records
+
+    def __getitem__(self, uprn):
+        return self.records[uprn]
+
+    def __len__(self):
+        return len(self.records)
+
+    def subset(self, uprns):
+        """ Returns the loaded records for some UPRNs as a plain dictionary,
+        which is cheap to send to a worker process
+        """
+        return {uprn: self.records[uprn] for uprn in uprns
+                if uprn in self.records}
+
+    def load(self, connection, uprns):
+        """ Fetches the rows for a list of UPRNs in as few queries as
+        possible, skipping any UPRNs that are already loaded
+        """
+        uprns = [uprn for uprn in uprns if uprn not in self.records]
+        for i in range(0, len(uprns), self.chunk_size):
+            chunk = uprns[i:i + self.chunk_size]
+            placeholders = ', '.join(['?'] * len(chunk))
+            with METRICS.stage('db'):
+                cursor = connection.cursor()
+                cursor.execute(self.query.format(placeholders), chunk)
+                rows = cursor.fetchall()
+            for row in rows:
+                # By position, as SQL Server may not give the columns the
+                # same names, or in the same case, as Record
+                record = Record(*row)
+                # The joins can match more than one round, so keep the first
+                self.records.setdefault(record.uprn, record)
+            cursor.close()
+
+
+def connect(connection_string):
+    """ Opens a connection to the database. pyodbc is only imported here and
+    when running against the database, as it needs an ODBC driver manager
+    that a machine rendering from a snapshot may not have.
+    """
+    import pyodbc
+    return pyodbc.connect(
+        driver=connection_string.driver,
+        server=connection_string.server,
+        database=connection_string.database,
+        uid=connection_string.uid,
+        pwd=connection_string.pwd)
+
+def connect_snapshot(path):
+    """ Opens a snapshot made by export_snapshot.py, read only. Connections
+    are shared between threads by the connection pool.
+    """
+    return sqlite3.connect(
+        'file:{}?mode=ro'.format(pathname2url(os.path.abspath(path))),
+        uri=True, check_same_thread=False)
+
+def is_transient(error):
+    """ Whether a database error is worth retrying on a new connection, such
+    as the server going away, a timeout or a deadlock. SQLite raises the same
+    error for a missing table or file as for a locked database, so only the
+    locked and busy errors are retried.
+    """
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error).lower()
+        return 'locked' in message or 'busy' in message
+    # pyodbc can't have raised the error if it was never imported
+    pyodbc = sys.modules.get('pyodbc')
+    if pyodbc is None:
+        return False
+    if isinstance(error, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+        return True
+    if isinstance(error, pyodbc.Error) and error.args:
+        # SQLSTATE class 08 is a connection exception
+        state = str(error.args[0])
+        return state.startswith('08') or state in ('40001', 'HYT00', 'HYT01')
+    return False
+
+
+class ConnectionPool:
+    """ Keeps a few open database connections to share between threads. A
+    query that fails because the connection dropped is tried again on a new
+    connection, waiting longer after each failure.
+    """
+
+    def __init__(self, factory, size=2, retries=5, backoff=1.0,
+                 max_backoff=60.0):
+        """ Sets how to open a connection, how many can be open at once and
+        how failures are retried. Connections are only opened when needed.
+        """
+        self.factory = factory
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.open_count = 0
+        self.retry_count = 0
+
+    def acquire(self):
+        """ Returns an idle connection, opening a new one if there's room in
+        the pool, or waits for one to be released
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if not can_open:
+            return self.idle.get()
+        try:
+            connection = self.factory()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+        self.open_count += 1
+        return connection
+
+    def release(self, connection):
+        """ Puts a connection back in the pool
+        """
+        self.idle.put(connection)
+
+    def discard(self, connection):
+        """ Closes a connection that has failed and makes room for a new one
+        """
+        try:
+            connection.close()
+        except Exception:
+            # It's being thrown away because it's already broken
+            pass
+        with self.lock:
+            self.opened -= 1
+
+    def wait_to_retry(self, attempt, error):
+        """ Waits before trying again after a failure, or raises the error if
+        it can't be retried or has failed too many times
+        """
+        if attempt >= self.retries or not is_transient(error):
+            raise error
+        self.retry_count += 1
+        # The wait doubles each time, with some jitter so threads don't all
+        # reconnect at once
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        delay *= random.uniform(0.5, 1.0)
+        print('Database error, retrying in {:.1f}s: {}'.format(delay, error))
+        time.sleep(delay)
+
+    def run(self, function):
+        """ Calls a function with a connection from the pool and returns what
+        it returns, retrying on a new connection if the database fails
+        """
+        attempt = 0
+        while True:
+            connection = None
+            try:
+                connection = self.acquire()
+                result = function(connection)
+            except Exception as error:
+                if connection is not None:
+                    self.discard(connection)
+                self.wait_to_retry(attempt, error)
+                attempt += 1
+                continue
+            self.release(connection)
+            return result
+
+    def stats(self):
+        """ Returns the connection counters as a string for logging
+        """
+        return 'Database: {} connections opened, {} retries'.format(
+            self.open_count, self.retry_count)
+
+    def close(self):
+        """ Closes the idle connections
+        """
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self.lock:
+                self.opened -= 1
+
+
+class RunJournal:
+    """ Keeps a record of every sheet in a run in a SQLite file, so a run that
+    stops part way through can carry on where it left off, and the UPRNs that
+    haven't been printed can be found with one query. The images rendered for
+    each sheet are also kept by the hash of the sheet's content, so a sheet
+    that hasn't changed can be reused by a later run wherever it is in the
+    batch.
+    """
+
+    def __init__(self, path, resume=False):
+        """ Opens the journal, starting it again unless the run is resuming
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        if not resume:
+            self.connection.executescript('''
+                DROP TABLE IF EXISTS sheets;
+                DROP TABLE IF EXISTS batch_uprns;
+                DROP TABLE IF EXISTS renders;''')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS sheets (
+                sheet_index INTEGER PRIMARY KEY,
+                uprns TEXT NOT NULL,
+                status TEXT NOT NULL,
+                address_path TEXT,
+                calendar_path TEXT,
+                error TEXT,
+                updated TEXT NOT NULL,
+                content_hash TEXT);
+            CREATE TABLE IF NOT EXISTS batch_uprns (
+                uprn TEXT PRIMARY KEY,
+                sheet_index INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS batch_uprns_sheet
+                ON batch_uprns (sheet_index);
+            CREATE TABLE IF NOT EXISTS renders (
+                content_hash TEXT PRIMARY KEY,
+                address_path TEXT NOT NULL,
+                calendar_path TEXT NOT NULL,
+                updated TEXT NOT NULL);''')
+        columns = [row[1] for row in self.connection.execute(
+            'PRAGMA table_info(sheets)')]
+        if 'content_hash' not in columns:
+            # Journals from before sheets were hashed
+            self.connection.execute(
+                'ALTER TABLE sheets ADD COLUMN content_hash TEXT')
+
+    def rendered(self, content_hash):
+        """ Returns the paths of the images rendered for a sheet with the same
+        content by an earlier run, if they're still there. Journals from
+        before vector sheets were kept without paths can hold page labels
+        here, which aren't files, so they're never reused.
+        """
+        row = self.connection.execute(
+            'SELECT address_path, calendar_path FROM renders '
+            'WHERE content_hash = ?', (content_hash,)).fetchone()
+        if row is None:
+            return None
+        if not (os.path.isfile(row[0]) and os.path.isfile(row[1])):
+            return None
+        return row[0], row[1]
+
+    def start(self, index, uprn_list, content_hash=None):
+        """ Records a sheet, its UPRNs and the hash of its content before it's
+        rendered
+        """
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sheets (sheet_index, uprns, status, '
+                'updated, content_hash) VALUES (?, ?, ?, ?, ?)',
+                (index, json.dumps(uprn_list), 'pending', time.ctime(),
+                 content_hash))
+            self.connection.execute(
+                'DELETE FROM batch_uprns WHERE sheet_index = ?', (index,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO batch_uprns VALUES (?, ?)',
+                [(uprn, index) for uprn in uprn_list if uprn is not None])
+
+    def finish(self, index, paths=None):
+        """ Records that a sheet's images have been saved, and keeps them by
+        the hash of its content to be reused. A sheet written straight into a
+        vector PDF has no images, so it's recorded with no paths.
+        """
+        with self.connection:
+            self.connection.execute(
+                'UPDATE sheets SET status = ?, address_path = ?, '
+                'calendar_path = ?, error = NULL, updated = ? '
+                'WHERE sheet_index = ?',
+                ('done', None if paths is None else paths[0],
+                 None if paths is None else paths[1], time.ctime(), index))
+            if paths is None:
+                return
+            # Images are named after their UPRNs, so an older render of the
+            # same UPRNs has just been written over
+            self.connection.execute(
+                'DELETE FROM renders WHERE address_path IN (?, ?) '
+                'OR calendar_path IN (?, ?)', tuple(paths) * 2)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO renders '
+                'SELECT content_hash, address_path, calendar_path, updated '
+                'FROM sheets WHERE sheet_index = ? '
+                'AND content_hash IS NOT NULL', (index,))
+
+    def fail(self, index, error):
+        """ Records that a sheet couldn't be rendered
+        """
+        with self.connection:
+            self.connection.execute(
+                'UPDATE sheets SET status = ?, error = ?, updated = ? '
+                'WHERE sheet_index = ?',
+                ('failed', error, time.ctime(), index))
+
+    def missing_uprns(self, batch=None):
+        """ Returns the UPRNs that haven't been printed. If a list of every
+        UPRN in the batch is given, UPRNs the run never reached are included.
+        """
+        if batch is None:
+            return [row[0] for row in self.connection.execute(
+                'SELECT b.uprn FROM batch_uprns b '
+                'JOIN sheets s ON s.sheet_index = b.sheet_index '
+                'WHERE s.status != ? ORDER BY b.sheet_index, b.uprn',
+                ('done',))]
+        self.connection.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS batch (uprn TEXT)')
+        self.connection.execute('DELETE FROM batch')
+        self.connection.executemany(
+            'INSERT INTO batch VALUES (?)', [(uprn,) for uprn in batch])
+        return [row[0] for row in self.connection.execute(
+            'SELECT i.uprn FROM batch i '
+            'LEFT JOIN batch_uprns b ON b.uprn = i.uprn '
+            'LEFT JOIN sheets s ON s.sheet_index = b.sheet_index '
+            'WHERE s.status IS NULL OR s.status != ?', ('done',))]
+
+    def trim(self, last_index):
+        """ Forgets the sheets after the last one in this run, which were left
+        from an earlier run of a bigger batch
+        """
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM batch_uprns WHERE sheet_index > ?',
+                (last_index,))
+            self.connection.execute(
+                'DELETE FROM sheets WHERE sheet_index > ?', (last_index,))
+
+    def close(self):
+        """ Closes the journal file
+        """
+        self.connection.close()
+
+
+class Card:
+    """ A single card, drawn from one of the CARD_LAYOUTS with the card's own
+    values filled in
+    """
+
+    def __init__(self, layout_name, values):
+        """ Fills in the text slots of the compiled layout
+        """
+        self.layout = ASSETS.layout(layout_name)
+        self.template = self.layout.template
+        self.slots = self.layout.fill(values)
+
+    def draw(self, base_image, x_coord, y_coord):
+        """ Draws the card straight on to a sheet with its top left corner at
+        the given coordinates
+        """
+        draw_card(base_image, self.template, self.slots, x_coord, y_coord)
+
+
+class SheetSide:
+    """ One side of a sheet: four cards drawn on a copy of the blank sheet in a
+    grid. The calendar side and the address side only differ in how their
+    images are named.
+    """
+
+    def __init__(self, cards):
+        """ Draws the cards, in the same order as CARD_POSITIONS, with None for
+        a blank card
+        """
+        self.cards = cards
+        self.positions = scaled_positions()
+        self.image = None
+        # In bands, the side is drawn as it's saved
+        if OUTPUT.band_height is None:
+            self.image = ASSETS.template(SHEET_TEMPLATE)
+            self.build()
+        self.new_file = None
+
+    def filename(self):
+        """ Returns the name of the image, without the folder or extension
+        """
+        raise NotImplementedError
+
+    def save(self):
+        """ Saves the image and returns its path
+        """
+        if self.image is None:
+            self.new_file = save_in_bands(
+                self.filename(), self.cards, self.positions,
+                OUTPUT.band_height)
+        else:
+            self.new_file = save_image(self.filename(), self.image)
+        return self.new_file
+
+    @METRICS.timed('compose')
+    def build(self):
+        """ Draws each card straight on to the blank page at the correct
+        position to create a 2x2 grid
+        """
+        for (x_coord, y_coord), card in zip(self.positions, self.cards):
+            if card is not None:
+                card.draw(self.image, x_coord, y_coord)
+
+
 class Calendar:
     """ Represents a set of days on which particular bins are collected.
     """
 
-    def __init__(self, connection, uprn):
+    def __init__(self, records, uprn):
         """ Maps each day to a date and calls the methods to create the
         calendar
         """
@@ -75,28 +929,32 @@ class Calendar:
             'Wednesday': 2,
             'Thursday': 3,
             'Friday': 4}
-        self.connection = connection
+        self.records = records
         self.uprn = uprn
         self.get_calendar_data()
         self.format_calendar_strings()
 
     def get_calendar_data(self):
-        """ Queries the database using to get the calendar data
-        """
-        with open('./cal_query.sql', 'r') as query_file:
-            query = query_file.read()
-            cursor = self.connection.cursor()
-            cursor.execute(query, self.uprn)
-            row = cursor.fetchone()
-            self.black_bin_day = row.REFDay
-            self.black_bin_week = row.REFWeek
-            self.recycling_bin_day = row.RECYDay
-            self.recycling_bin_week = row.RECYWeek
-            self.recycling_box_day = row.RECYDay
-            self.recycling_box_week = row.RECYWeek
-            self.green_bin_day = row.GWDay
-            self.green_bin_week = row.GWWeek
-            cursor.close()
+        """ Looks up the calendar data in the loaded records
+        """
+        row = self.records[self.uprn]
+        self.black_bin_day = row.REFDay
+        self.black_bin_week = row.REFWeek
+        self.recycling_bin_day = row.RECYDay
+        self.recycling_bin_week = row.RECYWeek
+        self.recycling_box_day = row.RECYDay
+        self.recycling_box_week = row.RECYWeek
+        self.green_bin_day = row.GWDay
+        self.green_bin_week = row.GWWeek
+
+    @property
+    def image_type(self):
+        """ Which calendar design the card needs
+        """
+        # If the recycling box and bins are collected simultaneously
+        if self.recycling_box_str == '':
+            return 'SAME_COLLECTION'
+        return 'DIFFERENT_COLLECTION'
 
     def format_calendar_strings(self):
         """ Formats the calendar data to match the design of the card
@@ -112,7 +970,7 @@ class Calendar:
         else:
             self.recycling_box_str = '{}   from   {} June 2018'.format(
                 self.recycling_box_day,
-                str((self.recycling_box_week * 7) + self.dates[self.recycling_bin_day] + 4))
+                str((self.recycling_box_week * 7) + self.dates[self.recycling_box_day] + 4))
         if self.green_bin_day is None:
             self.green_bin_str = 'Not collected'
         else:
@@ -121,7 +979,7 @@ class Calendar:
                 str((self.green_bin_week * 7) + self.dates[self.green_bin_day] + 4))
 
 
-class CalendarImage:
+class CalendarImage(Card):
     """ Represents a single image of some bins with some calendar data on top
     """
 
@@ -129,183 +987,73 @@ class CalendarImage:
         """ Sets some values used to generate the correct image
         """
         self.calendar = calendar
-        if index == 1:
-            self.index = 2
-        elif index == 2:
-            self.index = 1
-        elif index == 3:
-            self.index = 4
-        elif index == 4:
-            self.index = 3
-        self.calendar_font = ImageFont.truetype(
-            'futura bold condensed italic bt.ttf', 59)
-        self.index_font = ImageFont.truetype('consola.ttf', 40)
-        self.load_calendar_image()
-        self.image = self.build_calendar_image()
-
-    def load_calendar_image(self):
-        """ Loads the correct image based on image type
-        """
-        # If the recycling box and bins are collected simultaneously
-        if self.calendar.recycling_box_str == '':
-            self.image_type = 'SAME_COLLECTION'
-            self.calendar_image = Image.open(
-                './in/postcard-back-same-dates.jpg').convert('RGB')
-            self.calendar_image.load()
-
-    def build_calendar_image(self):
-        """ Builds the correct image using the background and calendar data
-        """
-        if self.image_type == 'SAME_COLLECTION':
-            black_bin_str = wrap_text(calendar.black_bin_str, 7)
-            black_bin_text = create_text_box(
-                black_bin_str,
-                # Width, height and rotation of the text box
-                300, 450, 4,
-                self.calendar_font,
-                255,
-                False)
-            paste_text_box(
-                self.calendar_image,
-                black_bin_text,
-                # X and Y coordinate of the text box
-                380, 710,
-                (255, 255, 255),
-                (255, 255, 255))
-            recycling_bin_str = wrap_text(calendar.recycling_bin_str, 7)
-            recycling_bin_text = create_text_box(
-                recycling_bin_str,
-                300, 450, 4,
-                self.calendar_font,
-                255,
-                False)
-            paste_text_box(
-                self.calendar_image,
-                recycling_bin_text,
-                1070, 710,
-                (255, 255, 255),
-                (255, 255, 255))
-            recycling_box_str = wrap_text(calendar.recycling_box_str, 7)
-            recycling_box_text = create_text_box(
-                recycling_box_str,
-                400, 250, 4,
-                self.calendar_font,
-                255,
-                False)
-            paste_text_box(
-                self.calendar_image,
-                recycling_box_text,
-                935, 710,
-                (255, 255, 255),
-                (255, 255, 255))
-            green_bin_str = wrap_text(calendar.green_bin_str, 7)
-            green_bin_text = create_text_box(
-                green_bin_str,
-                300, 450, 4,
-                self.calendar_font,
-                255,
-                False)
-            paste_text_box(
-                self.calendar_image,
-                green_bin_text,
-                1975, 710,
-                (255, 255, 255),
-                (255, 255, 255))
-            # Keeps track of corresponding addresses and calendars
-            number = create_text_box(
-                str(self.index),
-                100, 100, 0,
-                self.index_font,
-                255,
-                True)
-            paste_text_box(
-                self.calendar_image,
-                number,
-                0, 0,
-                (0, 0, 0),
-                (0, 0, 0))
-            uprn = create_text_box(
-                self.calendar.uprn,
-                1000, 100, 0,
-                self.index_font,
-                255,
-                True)
-            paste_text_box(
-                self.calendar_image,
-                uprn,
-                750, 0,
-                (0, 0, 0),
-                (0, 0, 0))
-        if self.image_type == 'DIFFERENT_COLLECTION':
-            print('TODO: handle different image collection')
-        return self.calendar_image
-
-
-class CalendarSide:
+        self.index = swap_calendar_index(index)
+        self.image_type = self.calendar.image_type
+        if self.image_type not in CARD_LAYOUTS:
+            # There's no template with a place for the box's own date yet
+            raise NotImplementedError(
+                'There is no {} calendar design for a recycling box collected '
+                'on a different day to the recycling bin'.format(
+                    self.image_type))
+        Card.__init__(self, self.image_type, {
+            'black_bin': calendar.black_bin_str,
+            'recycling_bin': calendar.recycling_bin_str,
+            'green_bin': calendar.green_bin_str,
+            'index': str(self.index),
+            'uprn': calendar.uprn})
+
+
+class CalendarSide(SheetSide):
     """ Represents a collection of four CalendarImage objects pasted on a
     blank image
     """
 
-    def __init__(self, calendar_image_list):
-        """ Defines the positions for the calendar images
+    def filename(self):
+        """ Names the image after the UPRNs on the sheet, in the same order as
+        the address side
         """
-        self.calendar_image_list = calendar_image_list
-        # X and Y offsets for top-left, top-right, bottom-left, bottom-right
-        self.positions = [(82, 47), (2657, 47), (82, 1890), (2657, 1890)]
-        self.calendar_side_image = Image.open(
-            './in/blank_sra3.jpg').convert('RGB')
-        self.calendar_side_image.load()
-        self.build_calendar_side()
         uprns = []
-        for calendar_image in self.calendar_image_list:
-            uprns.append(calendar_image.calendar.uprn)
+        for calendar_image in self.cards:
+            # Blank cards on the last sheet of a batch are None
+            if calendar_image is None:
+                uprns.append(None)
+            else:
+                uprns.append(calendar_image.calendar.uprn)
         # Reverts the UPRNs back to normal so filenames are the same
         unflipped_uprns = [uprns[2], uprns[3], uprns[0], uprns[1], 'cal']
-        self.new_file = save_image(
-            '-'.join(unflipped_uprns), self.calendar_side_image)
-
-    def build_calendar_side(self):
-        """ Pastes each CalendarImage at the correct position on the blank
-        page to create a 4x4 grid
-        """
-
-        for position, calendar_image in enumerate(self.calendar_image_list):
-            paste_image(
-                self.calendar_side_image,
-                calendar_image.image,
-                self.positions[position][0],
-                self.positions[position][1])
+        return '-'.join(uprn for uprn in unflipped_uprns if uprn is not None)
 
 
 class Address:
     """ Represents a Royal Mail standard address of a property
     """
 
-    def __init__(self, connection, uprn):
+    def __init__(self, records, uprn):
         """ Calls the methods to create an address
         """
-        self.connection = connection
+        self.records = records
         self.uprn = uprn
         self.get_address_data()
         self.format_address_string()
 
     def get_address_data(self):
-        """ Queries the database to get the address data
+        """ Looks up the address data in the loaded records
         """
-        with open('./cal_query.sql', 'r') as query_file:
-            query = query_file.read()
-            cursor = self.connection.cursor()
-            cursor.execute(query, self.uprn)
-            row = cursor.fetchone()
-            self.address_block = row.addressBlock
+        row = self.records[self.uprn]
+        self.address_block = row.addressBlock
 
     def format_address_string(self):
         """ Formats the address data to match the design of the card
         """
-        self.address_block = self.address_block.replace('<br>', '\n')
+        # The county is left off, ignoring case like the SQL Server REPLACE
+        # this used to be done with, and each line ends in a Windows line
+        # break
+        self.address_block = re.sub(
+            'north yorkshire\r\n', '', self.address_block,
+            flags=re.IGNORECASE).replace('\r\n', '\n')
 
 
-class AddressImage:
+class AddressImage(Card):
     """ Represents a single image of a postal address
     """
 
@@ -314,211 +1062,1390 @@ class AddressImage:
         """
         self.address = address
         self.index = index
-        self.address_font = ImageFont.truetype('arial.ttf', 45)
-        self.index_font = ImageFont.truetype('consola.ttf', 40)
-        self.address_image = Image.open(
-            './in/postcard-front.jpg').convert('RGB')
-
-        self.address_image.load()
-        self.build_address_image()
-
-    def build_address_image(self):
-        """ Builds the correct image using the background and address data
-        """
-        text_box = create_text_box(
-            self.address.address_block,
-            1900, 850, 0,
-            self.address_font,
-            255,
-            True)
-        paste_text_box(
-            self.address_image,
-            text_box,
-            500, 700,
-            (0, 0, 0),
-            (0, 0, 0))
-        number = create_text_box(
-            str(self.index),
-            100, 100, 0,
-            self.index_font,
-            255,
-            True)
-        paste_text_box(
-            self.address_image,
-            number,
-            0, 0,
-            (0, 0, 0),
-            (0, 0, 0))
-        uprn = create_text_box(
-            self.address.uprn,
-            1000, 100, 0,
-            self.index_font,
-            255,
-            True)
-        paste_text_box(
-            self.address_image,
-            uprn,
-            750, 0,
-            (0, 0, 0),
-            (0, 0, 0))
-
-
-class AddressSide:
-    """ Represents a collection of four AddressSide objects pasted on a blank
+        Card.__init__(self, 'ADDRESS', {
+            'address': address.address_block,
+            'index': str(self.index),
+            'uprn': address.uprn})
+
+
+class AddressSide(SheetSide):
+    """ Represents a collection of four AddressImage objects pasted on a blank
     image
     """
 
-    def __init__(self, address_image_list):
-        """ Defines the positions for the calendar images
+    def filename(self):
+        """ Names the image after the UPRNs on the sheet
         """
-        self.address_image_list = address_image_list
-        # X and y offsets for top-left, top-right, bottom-left, bottom-right
-        self.positions = [(82, 47), (2657, 47), (82, 1890), (2657, 1890)]
-        self.address_side_image = Image.open(
-            './in/blank_sra3.jpg').convert('RGB')
-        self.address_side_image.load()
-        self.build_address_side()
         filename = ['addr']
-        for address_image in self.address_image_list:
-            filename = [address_image.address.uprn] + filename
-        self.new_file = save_image('-'.join(filename), self.address_side_image)
+        for address_image in self.cards:
+            # Blank cards on the last sheet of a batch are None
+            if address_image is not None:
+                filename = [address_image.address.uprn] + filename
+        return '-'.join(filename)
 
-    def build_address_side(self):
-        """ Pastes each AddressImage at the correct position on the blank page
-        to create a 4x4 grid
-        """
-        for position, address_image in enumerate(self.address_image_list):
-            paste_image(
-                self.address_side_image,
-                address_image.address_image,
-                self.positions[position][0],
-                self.positions[position][1])
 
-
-def get_uprns(connection):
-    """ Gets a list of 1000 UPRNs from the database and splits them into a
-    list of lists, each sublist containing 4 elements.
+def iter_uprns(pool, batch_size=1000):
+    """ Yields the UPRNs in the batch, fetching them from the database a few
+    at a time. The stream keeps a connection from the pool to itself. If it
+    drops, the query is run again on a new connection and the UPRNs that were
+    already yielded are skipped, which relies on the query's ORDER BY. The
+    retries start again once more UPRNs have come through, so a long stream
+    can survive any number of drops that aren't one after another.
     """
-    uprns = []
-    with open('./uprn_query.sql', 'r') as query_file:
+    with open(QUERIES.uprns, 'r') as query_file:
         query = query_file.read()
-        cursor = connection.cursor()
-        cursor.execute(query)
-        uprn_col = cursor.fetchall()
-        for row in uprn_col:
-            uprns.append(row[0])
-        return [uprns[i:i + 4] for i in range(0, len(uprns), 4)]
+    yielded = 0
+    attempt = 0
+    while True:
+        connection = None
+        yielded_before = yielded
+        try:
+            connection = pool.acquire()
+            with METRICS.stage('db'):
+                cursor = connection.cursor()
+                cursor.execute(query)
+            # Skips the UPRNs yielded before the last connection dropped
+            to_skip = yielded
+            while True:
+                with METRICS.stage('db'):
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    if to_skip:
+                        to_skip -= 1
+                        continue
+                    yielded += 1
+                    yield row[0]
+            cursor.close()
+        except GeneratorExit:
+            # The rest of the UPRNs aren't wanted, and a connection with rows
+            # still to read can't go back in the pool
+            pool.discard(connection)
+            raise
+        except Exception as error:
+            if connection is not None:
+                pool.discard(connection)
+            if yielded > yielded_before:
+                attempt = 0
+            pool.wait_to_retry(attempt, error)
+            attempt += 1
+            continue
+        pool.release(connection)
+        return
+
+def count_uprns(pool):
+    """ Counts the UPRNs in the batch, so progress can be shown out of the
+    total. SQL Server doesn't allow ORDER BY in a subquery, so it's taken off.
+    """
+    with open(QUERIES.uprns, 'r') as query_file:
+        query = query_file.read().strip().rstrip(';')
+    order_by = query.upper().rfind('ORDER BY')
+    if order_by != -1:
+        query = query[:order_by]
+
+    def count(connection):
+        with METRICS.stage('db'):
+            cursor = connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM ({}) AS uprns'.format(query))
+            result = cursor.fetchone()[0]
+            cursor.close()
+        return result
+    return pool.run(count)
+
+def read_uprns(path):
+    """ Yields the UPRNs in the first column of a CSV or text file
+    """
+    with open(path, newline='') as uprn_file:
+        for row in csv.reader(uprn_file):
+            if row and row[0].strip():
+                yield row[0].strip()
+
+def iter_chunks(iterable, size):
+    """ Splits an iterable into lists of a given size as it's read, so only one
+    list is held in memory at a time. The last list may be shorter.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def group_sheets(uprns):
+    """ Splits UPRNs into lists of four, one for each sheet. If the last sheet
+    isn't full it's padded with None, which leaves a blank card, so no UPRNs
+    are dropped.
+    """
+    for sheet in iter_chunks(uprns, 4):
+        yield sheet + [None] * (4 - len(sheet))
+
+def get_uprns(pool):
+    """ Gets the UPRNs from the database and splits them into lists of four as
+    they're needed
+    """
+    return group_sheets(iter_uprns(pool))
+
+def load_records(pool, uprns):
+    """ Loads the records for some UPRNs into a new RecordStore. If the
+    connection drops part way through, only the UPRNs that weren't loaded are
+    fetched again.
+    """
+    records = RecordStore()
+    pool.run(lambda connection: records.load(connection, uprns))
+    return records
+
+def shard_sheets(numbered_sheets, shard, shard_count):
+    """ Keeps the sheets that belong to one shard of a batch split between
+    shard_count machines or processes. Sheets are dealt out in turn by their
+    index, so every shard numbers its sheets the same as a run of the whole
+    batch would, and the shards all get about the same number of sheets.
+    """
+    for index, uprn_list in numbered_sheets:
+        if (index - 1) % shard_count == shard - 1:
+            yield index, uprn_list
+
+def shard_sheet_count(sheet_count, shard, shard_count):
+    """ The number of sheets in one shard of a batch of sheet_count sheets
+    """
+    return max((sheet_count - shard) // shard_count + 1, 0)
 
+def write_snapshot(pool, uprns, path, chunk_size=1000):
+    """ Saves the UPRNs in a batch, in order, and their records to a SQLite
+    file that the batch can be rendered from with --snapshot, without the
+    database. The records are loaded a thousand UPRNs at a time, the same as
+    for rendering. The file is written under a temporary name and renamed once
+    it's complete. Returns the number of UPRNs and records saved.
+    """
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    snapshot = sqlite3.connect(temp_path)
+    snapshot.executescript(SNAPSHOT_SCHEMA)
+    for chunk in iter_chunks(uprns, chunk_size):
+        records = load_records(pool, chunk)
+        snapshot.executemany(
+            'INSERT INTO batch (uprn) VALUES (?)', [(uprn,) for uprn in chunk])
+        snapshot.executemany(
+            'INSERT OR IGNORE INTO records VALUES ({})'.format(
+                ', '.join(['?'] * len(Record._fields))),
+            [tuple(records[uprn]) for uprn in chunk if uprn in records])
+    uprn_count, record_count = snapshot.execute(
+        'SELECT (SELECT COUNT(*) FROM batch), '
+        '(SELECT COUNT(*) FROM records)').fetchone()
+    snapshot.execute(
+        'INSERT INTO snapshot VALUES (?, ?, ?)',
+        (time.ctime(), uprn_count, record_count))
+    snapshot.commit()
+    snapshot.close()
+    os.replace(temp_path, path)
+    return uprn_count, record_count
+
+def sheet_tasks(sheets, pool, journal=None, chunk_size=250, prefetch=1,
+                shard=None, reuse=True):
+    """ Yields a SheetTask for each sheet, or each sheet in a shard given as
+    (shard, shard_count). The records for each chunk of sheets are loaded in
+    one go on a background thread, which works through the next few chunks
+    while the sheets in the current one are rendered. Sheets with the same
+    content as a sheet the journal has images for are reused, unless reuse is
+    False, as it is for vector output, which can't use the images.
+    """
+    assets = None if journal is None else asset_hash()
+    numbered_sheets = enumerate(sheets, 1)
+    if shard is not None:
+        numbered_sheets = shard_sheets(numbered_sheets, *shard)
+    with ThreadPoolExecutor(1) as executor:
+        pending = deque()
+        for chunk in iter_chunks(numbered_sheets, chunk_size):
+            loading = executor.submit(load_records, pool, [
+                uprn for index, uprn_list in chunk for uprn in uprn_list
+                if uprn is not None])
+            pending.append((chunk, loading))
+            if len(pending) > prefetch:
+                yield from chunk_tasks(
+                    *pending.popleft(), journal, assets, reuse)
+        while pending:
+            yield from chunk_tasks(*pending.popleft(), journal, assets, reuse)
+
+def chunk_tasks(chunk, loading, journal, assets, reuse=True):
+    """ Yields a SheetTask for each sheet in a chunk once its records have
+    loaded, recording each one in the journal
+    """
+    records = loading.result()
+    for index, uprn_list in chunk:
+        done = None
+        if journal is not None:
+            content_hash = sheet_hash(uprn_list, records, assets)
+            if reuse:
+                done = journal.rendered(content_hash)
+            journal.start(index, uprn_list, content_hash)
+        if done is not None:
+            yield SheetTask(index, uprn_list, {}, done)
+        else:
+            yield SheetTask(
+                index, uprn_list, records.subset(uprn_list), None)
+
+def file_hash(path):
+    """ Returns the SHA-256 hash of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def asset_hash():
+    """ Returns a hash of the layout version, the scale and the template and
+    font files, so changing any of them changes the hash of every sheet
+    """
+    digest = hashlib.sha256('{} {}'.format(
+        LAYOUT_VERSION, ASSETS.scale).encode('ascii'))
+    paths = [os.path.join(ASSETS.template_dir, filename) for filename in
+             (SHEET_TEMPLATE, CALENDAR_TEMPLATE, ADDRESS_TEMPLATE)]
+    paths += sorted(set(
+        ASSETS.font(filename, size).path for filename, size in FONTS))
+    for path in paths:
+        digest.update(file_hash(path).encode('ascii'))
+    return digest.hexdigest()
+
+def sheet_hash(uprn_list, records, assets):
+    """ Returns a hash of everything a sheet is made from: its UPRNs and
+    their address and calendar data, the template and font files and the
+    layout version. Two sheets with the same hash look exactly the same.
+    """
+    rows = [None if uprn is None or uprn not in records
+            else list(records[uprn]) for uprn in uprn_list]
+    content = json.dumps([assets, uprn_list, rows])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def check_record(record):
+    """ Returns a Reject for each field of a record that the cards can't be
+    made from: a missing address, or a collection day or week that's NULL or
+    out of range. Garden waste can be missing as long as both the day and the
+    week are.
+    """
+    rejects = []
+    if record.addressBlock is None or not record.addressBlock.strip():
+        rejects.append(Reject(
+            record.uprn, 'addressBlock', record.addressBlock, 'no address'))
+    for day_column, week_column, required in SERVICE_COLUMNS:
+        day = getattr(record, day_column)
+        week = getattr(record, week_column)
+        if day is None and week is None and not required:
+            continue
+        if day not in COLLECTION_DAYS:
+            rejects.append(Reject(
+                record.uprn, day_column, day,
+                'not a collection day from Monday to Friday'))
+        if week not in (0, 1):
+            rejects.append(Reject(
+                record.uprn, week_column, week, 'week should be 0 or 1'))
+    return rejects
+
+def text_overflow(slot):
+    """ Returns why the text in a slot doesn't fit in its box, or None if it
+    fits, measuring each line the same way the text box is laid out
+    """
+    for x_coord, y_coord, line in TEXT.layout(
+            slot.text, slot.width, slot.font, slot.multiline):
+        line_width, line_height = TEXT.line_size(line, slot.font)
+        if line_width > slot.width:
+            return '"{}" is {}px wide but the box is {}px'.format(
+                line, line_width, slot.width)
+        if y_coord + line_height > slot.height:
+            return 'the text is {}px high but the box is {}px'.format(
+                y_coord + line_height, slot.height)
+    return None
+
+def unprintable_characters(text):
+    """ Returns the characters in some text that a vector PDF can't show, as
+    its fonts use the WinAnsi (cp1252) character set and anything else comes
+    out as a question mark
+    """
+    missing = set()
+    for char in text:
+        try:
+            char.encode('cp1252')
+        except UnicodeEncodeError:
+            missing.add(char)
+    return ''.join(sorted(missing))
+
+def slot_texts(card):
+    """ Returns each field on a card with its text as it's printed
+    """
+    return [(field, slot.text if slot.multiline else ' '.join(slot.text))
+            for field, slot in zip(card.layout.fields, card.slots)]
+
+def check_uprn(records, uprn, vector=False):
+    """ Returns a Reject for every problem that would stop a UPRN's cards
+    being drawn properly, or an empty list if there are none. Text that a
+    vector PDF can't show is only a problem for vector output.
+    """
+    if uprn not in records:
+        return [Reject(uprn, 'uprn', uprn, 'not found by cal_query.sql')]
+    rejects = check_record(records[uprn])
+    if rejects:
+        return rejects
+    try:
+        cards = [AddressImage(Address(records, uprn), 1),
+                 CalendarImage(Calendar(records, uprn), 1)]
+    except Exception as error:
+        return [Reject(uprn, 'record', None, repr(error))]
+    for card in cards:
+        for slot, (field, text) in zip(card.slots, slot_texts(card)):
+            problem = text_overflow(slot)
+            if problem is not None:
+                rejects.append(Reject(uprn, field, text, problem))
+            missing = unprintable_characters(text) if vector else ''
+            if missing:
+                rejects.append(Reject(
+                    uprn, field, text,
+                    'a vector PDF would print {} as ?'.format(missing)))
+    return rejects
+
+@METRICS.timed('preflight')
+def preflight(uprns, pool, report_path, chunk_size=1000, vector=False):
+    """ Checks the data for every UPRN in the batch before anything is
+    rendered, for vector output if vector is True. The records are loaded a
+    thousand UPRNs at a time, the same as for rendering, and every problem
+    found is written to a CSV report. Returns the UPRNs that passed, in
+    order, and the Rejects.
+    """
+    passed = []
+    rejects = []
+    for chunk in iter_chunks(uprns, chunk_size):
+        records = load_records(pool, chunk)
+        for uprn in chunk:
+            uprn_rejects = check_uprn(records, uprn, vector)
+            if uprn_rejects:
+                rejects.extend(uprn_rejects)
+            else:
+                passed.append(uprn)
+    with open(report_path, 'w', newline='') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(Reject._fields)
+        writer.writerows(rejects)
+    return passed, rejects
+
+def swap_calendar_index(index):
+    """ Maps the position of a calendar on its sheet to the index of the
+    address card it's printed on the back of
+    """
+    if index == 1:
+        return 2
+    elif index == 2:
+        return 1
+    elif index == 3:
+        return 4
+    elif index == 4:
+        return 3
+
+@functools.lru_cache(maxsize=1024)
 def wrap_text(string, width):
-    """ Wraps a given string on to multiple lines to fit the image
+    """ Wraps a given string on to multiple lines to fit the image. Calendar
+    strings repeat across the batch, so the lines are kept.
     """
-    return textwrap.wrap(
+    return tuple(textwrap.wrap(
         string,
         width=width,
         replace_whitespace=False,
-        break_long_words=False)
+        break_long_words=False))
 
-def create_text_box(string, width, height, rotation, font, fill, multiline):
-    """ Creates a text box to hold some string data
+def create_text_box(string, width, height, rotation, font, multiline):
+    """ Creates a text box to hold some string data, returned as a mask
     """
-    text_box = Image.new('L', (width, height))
-    text_box_draw = ImageDraw.Draw(text_box)
-    # If the string doesn't have built-in linebreaks (i.e. calendar string)
-    if not multiline:
-        padding = 10
-        current_height = 50
-        for line in string:
-            line_width, line_height = text_box_draw.textsize(line, font=font)
-            # Writes the text to the box so it's centre aligned
-            text_box_draw.text(
-                ((width - line_width) / 2, current_height),
-                line,
-                font=font,
-                fill=fill)
-            current_height += line_height + padding
-    else:
-        text_box_draw.multiline_text(
-            (0, 0), string, font=font, fill=fill, spacing=20)
-    return text_box.rotate(rotation, resample=Image.BICUBIC, expand=True)
+    return TEXT.text_box(string, width, height, rotation, font, multiline)
+
+def paste_text_box(base_image, text_box, x_coord, y_coord, rgb, clip=None):
+    """ Fills the text in a text box on to an image in a solid colour, given a
+    set of coordinates. Anything outside the clip box, if there is one, is
+    left off.
+    """
+    box = (x_coord, y_coord,
+           x_coord + text_box.size[0], y_coord + text_box.size[1])
+    if clip is not None:
+        clipped = (max(box[0], clip[0]), max(box[1], clip[1]),
+                   min(box[2], clip[2]), min(box[3], clip[3]))
+        if clipped[0] >= clipped[2] or clipped[1] >= clipped[3]:
+            return
+        if clipped != box:
+            text_box = text_box.crop((
+                clipped[0] - x_coord, clipped[1] - y_coord,
+                clipped[2] - x_coord, clipped[3] - y_coord))
+            box = clipped
+    base_image.paste(rgb, box, text_box)
+
+@functools.lru_cache(maxsize=256)
+def rotated_size(width, height, rotation):
+    """ Returns the size of a box after Image.rotate() with expand=True
+    """
+    if rotation % 360 == 0:
+        return width, height
+    angle = math.radians(rotation)
+    cos = math.cos(angle)
+    sin = math.sin(angle)
+    centre_x = width / 2
+    centre_y = height / 2
+    corners = [(0, 0), (width, 0), (width, height), (0, height)]
+    xs = [centre_x + (x - centre_x) * cos + (y - centre_y) * sin
+          for x, y in corners]
+    ys = [centre_y - (x - centre_x) * sin + (y - centre_y) * cos
+          for x, y in corners]
+    return (math.ceil(max(xs)) - math.floor(min(xs)),
+            math.ceil(max(ys)) - math.floor(min(ys)))
+
+def pdf_font_metrics(path):
+    """ Measures a font for embedding in a PDF, in thousandths of the font
+    size
+    """
+    font = ImageFont.truetype(path, 1000)
+    widths = []
+    for code in range(32, 256):
+        try:
+            char = bytes([code]).decode('cp1252')
+        except UnicodeDecodeError:
+            # A few codes aren't used in the WinAnsi character set
+            widths.append(0)
+            continue
+        if hasattr(font, 'getlength'):
+            widths.append(int(round(font.getlength(char))))
+        else:
+            widths.append(font.getsize(char)[0])
+    ascent, descent = font.getmetrics()
+    name = ''.join(
+        part.capitalize() for part in os.path.splitext(
+            os.path.basename(path))[0].split() if part.isalnum())
+    return {
+        'name': name,
+        'first_char': 32,
+        'widths': widths,
+        'ascent': ascent,
+        'descent': descent,
+        'cap_height': int(ascent * 0.7)}
+
+def draw_text_slot(base_image, slot, x_offset=0, y_offset=0, clip=None):
+    """ Draws a piece of text on to an image, moved by an offset. Text that
+    would be entirely outside the clip box isn't laid out at all.
+    """
+    if clip is not None:
+        width, height = rotated_size(slot.width, slot.height, slot.rotation)
+        left = x_offset + slot.x
+        top = y_offset + slot.y
+        # Leaves a couple of pixels spare in case Image.rotate() rounds the
+        # size differently
+        if (left - 2 >= clip[2] or top - 2 >= clip[3]
+                or left + width + 2 <= clip[0]
+                or top + height + 2 <= clip[1]):
+            return
+    paste_text_box(
+        base_image,
+        create_text_box(
+            slot.text, slot.width, slot.height, slot.rotation, slot.font,
+            slot.multiline),
+        x_offset + slot.x, y_offset + slot.y,
+        slot.rgb, clip)
 
-def paste_text_box(base_image, text_box, x_coord, y_coord, rgb_black, rgb_white):
-    """ Pastes a text box on to an image, given a set of coordinates
+def draw_card(base_image, template, slots, x_coord, y_coord):
+    """ Draws a card's template and text straight on to a sheet, without
+    making an image of the card first. The text is clipped to the card, the
+    same as if the card had been drawn on its own.
     """
-    base_image.paste(
-        ImageOps.colorize(
-            text_box,
-            rgb_black,
-            rgb_white),
-        (x_coord, y_coord),
-        text_box)
+    background = ASSETS.load_template(template)
+    base_image.paste(background, (x_coord, y_coord))
+    # The card can hang off the edge of a band
+    clip = (max(x_coord, 0), max(y_coord, 0),
+            min(x_coord + background.size[0], base_image.size[0]),
+            min(y_coord + background.size[1], base_image.size[1]))
+    for slot in slots:
+        draw_text_slot(base_image, slot, x_coord, y_coord, clip)
 
-def paste_image(base_image, image_to_paste, x_coord, y_coord):
-    """ Pasts an image on to another image, given a set of coordinates
+def scaled_positions():
+    """ Returns the positions of the cards on a sheet at the resolution being
+    rendered
     """
-    base_image.paste(image_to_paste, (x_coord, y_coord))
+    return [(ASSETS.scaled(x_coord), ASSETS.scaled(y_coord))
+            for x_coord, y_coord in CARD_POSITIONS]
 
-def save_image(filename, image):
-    """ Saves an image to file
+@METRICS.timed('compose')
+def compose_band(sheet, cards, positions, top, bottom):
+    """ Draws the rows of a side of a sheet from top to bottom, with the cards
+    that cross them
     """
-    out_path = './out/{}.jpg'.format(filename)
-    image.save(
-        out_path, quality=95, dpi=(300,300), optimize=True)
+    band = sheet.crop((0, top, sheet.size[0], bottom))
+    for (x_coord, y_coord), card in zip(positions, cards):
+        if card is None:
+            continue
+        if y_coord < bottom and y_coord + card.layout.size[1] > top:
+            card.draw(band, x_coord, y_coord - top)
+    return band
+
+def save_in_bands(filename, cards, positions, band_height):
+    """ Draws a side of a sheet a band of rows at a time into a memory mapped
+    file, then saves it as a JPEG straight from the file. Only one band is
+    held in memory while drawing, rather than the whole side, and the
+    operating system can page the finished bands out to disk. Returns the
+    path of the saved image.
+    """
+    sheet = ASSETS.load_template(SHEET_TEMPLATE)
+    width, height = sheet.size
+    # Pillow can only use a buffer without copying it for four byte pixels
+    row_bytes = width * 4
+    # Kept next to the images rather than in the temp folder, which may be
+    # held in memory
+    with tempfile.TemporaryFile(dir=OUTPUT.out_dir) as raw_file:
+        raw_file.truncate(row_bytes * height)
+        with mmap.mmap(raw_file.fileno(), row_bytes * height) as pixels:
+            for top in range(0, height, band_height):
+                bottom = min(top + band_height, height)
+                band = compose_band(sheet, cards, positions, top, bottom)
+                pixels[top * row_bytes:bottom * row_bytes] = band.tobytes(
+                    'raw', 'RGBX')
+            image = Image.frombuffer(
+                'RGBX', (width, height), pixels, 'raw', 'RGBX', 0, 1)
+            try:
+                path = save_image(filename, image, optimize=False)
+            finally:
+                # The map can't be closed while the image is using it, and
+                # if the save failed the traceback still holds the image, so
+                # it's closed as well as deleted to let go of the map
+                image.close()
+                del image
+    return path
+
+@METRICS.timed('save')
+def save_image(filename, image, optimize=True):
+    """ Saves an image to file. It's written to a temporary file that's
+    renamed once it's complete, so a crash never leaves half an image in the
+    output folder. Optimising the JPEG's Huffman tables makes the file a
+    little smaller, but the encoder has to hold the whole image to do it.
+    """
+    out_path = '{}/{}.jpg'.format(OUTPUT.out_dir, filename)
+    temp_path = out_path + '.tmp'
+    try:
+        image.save(
+            temp_path, format='JPEG', quality=OUTPUT.quality,
+            dpi=(OUTPUT.dpi, OUTPUT.dpi), optimize=optimize)
+        os.replace(temp_path, out_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
     return out_path
 
-def convert_to_pdf():
-    """ Converts all the images in the output folder into a single PDF with
-    each image on one page
-    """
-    paths = sorted([os.path.join('./out', f) for f in next(os.walk('./out'))[2]])
-    # Splits paths into groups to avoid MemoryErrors
-    paths = [paths[i:i + 150] for i in range(0, len(paths), 150)]
-    list_count = 0
-    img_count = 0
-    for sublist in paths:
-        loaded_images = []
-        for image in sublist:
-            if img_count % 150 == 0:
-                first_image = Image.open(image)
-            else:
-                loaded_images.append(Image.open(image))
-            img_count += 1
-        list_count += 1
-        path = './{}-output.pdf'.format(list_count)
-        first_image.save(
-            # Resolution is not a percentage, but the DPI values
-            path, 'PDF', resolution=300, save_all=True,
-            append_images=loaded_images)
-        print('Saved {} images'.format(img_count))
-        # Garbage collection to stop MemoryErrors
-        del loaded_images
-        gc.collect()
+@METRICS.timed('pdf')
+def convert_to_pdf(max_pages=150, max_bytes=None, paths=None):
+    """ Converts the images from a run, or all the images in the output folder
+    if no paths are given, into PDFs with each image on one page
+    """
+    if paths is None:
+        paths = sorted([
+            os.path.join('./out', f) for f in next(os.walk('./out'))[2]
+            if f.lower().endswith('.jpg')])
+    spooler = PdfSpooler(max_pages, max_bytes)
+    for image in paths:
+        spooler.add_image(image)
+    spooler.close()
+
+def write_shard_manifest(path, shard, shard_count, batch_sheets, sheets,
+                         failed):
+    """ Writes a list of the images a shard rendered, in sheet order, for
+    merge_shards.py to put the shards' images back in order. It's written
+    when the shard finishes, so a shard without one hasn't.
+    """
+    with open(path, 'w') as manifest_file:
+        json.dump({
+            'shard': shard,
+            'shard_count': shard_count,
+            'batch_sheets': batch_sheets,
+            'sheets': [
+                [index, [os.path.basename(image_path) for image_path in paths]]
+                for index, paths in sheets],
+            'failed': failed}, manifest_file, indent=1)
+
+def merge_shards(shard_dirs):
+    """ Reads the manifests of every shard of a batch and returns the paths of
+    all their images in the same order as a run of the whole batch, and the
+    indexes of any sheets that weren't rendered. The images are looked for
+    next to each manifest, so the shards' folders can be copied from other
+    machines. Raises ValueError if the folders aren't all the shards of the
+    same batch or a shard hasn't finished.
+    """
+    manifests = {}
+    for shard_dir in shard_dirs:
+        manifest_path = os.path.join(shard_dir, 'shard.json')
+        if not os.path.exists(manifest_path):
+            raise ValueError('{} has no shard.json, so it hasn\'t '
+                             'finished'.format(shard_dir))
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['shard'] in manifests:
+            raise ValueError('Shard {} is in more than one folder'.format(
+                manifest['shard']))
+        manifest['dir'] = shard_dir
+        manifests[manifest['shard']] = manifest
+    if not manifests:
+        raise ValueError('No shards to merge')
+    first = next(iter(manifests.values()))
+    for manifest in manifests.values():
+        if (manifest['shard_count'], manifest['batch_sheets']) != (
+                first['shard_count'], first['batch_sheets']):
+            raise ValueError(
+                '{} and {} are from different batches or a different number '
+                'of shards'.format(first['dir'], manifest['dir']))
+    missing_shards = sorted(
+        set(range(1, first['shard_count'] + 1)) - set(manifests))
+    if missing_shards:
+        raise ValueError('Shard(s) {} of {} are missing'.format(
+            ', '.join(str(shard) for shard in missing_shards),
+            first['shard_count']))
+    sheets = {}
+    for manifest in manifests.values():
+        for index, filenames in manifest['sheets']:
+            sheets[index] = [os.path.join(manifest['dir'], filename)
+                             for filename in filenames]
+    missing = [index for index in range(1, first['batch_sheets'] + 1)
+               if index not in sheets]
+    paths = [path for index in sorted(sheets) for path in sheets[index]]
+    return paths, missing
+
+def write_contact_sheet(sheets, path, sheets_per_page=3):
+    """ Puts the proof images from a run into one PDF, with the address side
+    and calendar side of each sheet next to each other, a few sheets to an A3
+    page, each labelled with its sheet number and UPRNs. The JPEGs are copied
+    in without being decoded.
+    """
+    page_width, page_height = 1191, 842
+    margin = 18
+    label_height = 14
+    cell_width = (page_width - 3 * margin) / 2
+    cell_height = (page_height - margin
+                   - sheets_per_page * (label_height + margin)) / sheets_per_page
+    writer = PdfWriter(path)
+    font = writer.add_object(
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+        b'/Encoding /WinAnsiEncoding >>')
+    for page in iter_chunks(sheets, sheets_per_page):
+        content = []
+        xobjects = {}
+        for row, (index, paths) in enumerate(page):
+            top = page_height - margin - row * (
+                cell_height + label_height + margin)
+            label = 'Sheet {}: {}'.format(
+                index, os.path.basename(paths[0])[:-len('-addr.jpg')])
+            content.append('BT /F0 9 Tf {} {} Td '.format(
+                margin, pdf_number(top - 9)).encode('ascii')
+                           + pdf_string(label) + b' Tj ET')
+            for column, image_path in enumerate(paths):
+                width, height = read_image_size(image_path)
+                scale = min(cell_width / width, cell_height / height)
+                name = 'Im{}'.format(len(xobjects))
+                xobjects[name] = writer.add_jpeg(image_path)
+                content.append('q {} 0 0 {} {} {} cm /{} Do Q'.format(
+                    pdf_number(width * scale), pdf_number(height * scale),
+                    pdf_number(margin + column * (cell_width + margin)),
+                    pdf_number(top - label_height - height * scale),
+                    name).encode('ascii'))
+        writer.add_page(
+            page_width, page_height, b'\n'.join(content), xobjects=xobjects,
+            fonts={'F0': font})
+    writer.close()
+    print('Saved {} sheets to {}'.format(len(sheets), path))
+
+
+class VectorPdf:
+    """ Writes sheets straight into PDFs instead of rendering JPEGs. Each
+    template image is embedded once per file and shared by every page, and
+    the text is written as real PDF text using the same fonts, positions and
+    rotations as the JPEG cards.
+    """
+
+    def __init__(self, max_pages=150, max_bytes=None, dpi=300):
+        """ Sets when to start a new file and the scale from pixels to points
+        """
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.scale = 72 / dpi
+        self.file_count = 0
+        self.page_count = 0
+        self.writer = None
+        self.path = None
+        self.font_metrics = {}
+
+    def start_file(self):
+        """ Opens the next numbered output file under its temporary name, like
+        PdfSpooler
+        """
+        self.file_count += 1
+        self.path = './{}-output.pdf'.format(self.file_count)
+        self.writer = PdfWriter(self.path + '.part')
+        self.images = {}
+        self.fonts = {}
+
+    def image(self, filename):
+        """ Returns the resource name and size of a template, embedding it in
+        the current file the first time it's used
+        """
+        if filename not in self.images:
+            path = os.path.join(ASSETS.template_dir, filename)
+            width, height = read_image_size(path)
+            self.images[filename] = (
+                'Im{}'.format(len(self.images)),
+                self.writer.add_image(path),
+                width, height)
+        return self.images[filename]
+
+    def font(self, font):
+        """ Returns the resource name of a font, embedding it in the current
+        file the first time it's used
+        """
+        if font.path not in self.fonts:
+            if font.path not in self.font_metrics:
+                self.font_metrics[font.path] = pdf_font_metrics(font.path)
+            self.fonts[font.path] = (
+                'F{}'.format(len(self.fonts)),
+                self.writer.add_truetype_font(
+                    font.path, **self.font_metrics[font.path]))
+        return self.fonts[font.path][0]
+
+    @METRICS.timed('pdf')
+    def add_sheet(self, address_cards, calendar_cards):
+        """ Adds the address side and the calendar side of a sheet as two
+        pages. Each card is a (template, text slots) pair, in the same order
+        as CARD_POSITIONS, or None for a blank card.
+        """
+        if self.writer is None:
+            self.start_file()
+        self.add_side(address_cards)
+        self.add_side(calendar_cards)
+        pages = len(self.writer.pages)
+        if pages >= self.max_pages or (
+                self.max_bytes is not None
+                and self.writer.size >= self.max_bytes):
+            self.close()
+
+    def add_side(self, cards):
+        """ Adds one side of a sheet as a page
+        """
+        scale = self.scale
+        sheet, _, sheet_width, sheet_height = self.image(SHEET_TEMPLATE)
+        content = ['q {} 0 0 {} 0 0 cm /{} Do Q'.format(
+            pdf_number(sheet_width * scale), pdf_number(sheet_height * scale),
+            sheet).encode('ascii')]
+        for (x_offset, y_offset), card in zip(CARD_POSITIONS, cards):
+            # Blank cards on the last sheet of a batch are None
+            if card is None:
+                continue
+            template, slots = card
+            name, _, width, height = self.image(template)
+            content.append('q {} 0 0 {} {} {} cm /{} Do Q'.format(
+                pdf_number(width * scale), pdf_number(height * scale),
+                pdf_number(x_offset * scale),
+                pdf_number((sheet_height - y_offset - height) * scale),
+                name).encode('ascii'))
+            for slot in slots:
+                content.append(
+                    self.slot_content(slot, x_offset, y_offset, sheet_height))
+        self.writer.add_page(
+            sheet_width * scale, sheet_height * scale, b'\n'.join(content),
+            xobjects={name: number
+                      for name, number, _, _ in self.images.values()},
+            fonts={name: number for name, number in self.fonts.values()})
+        self.page_count += 1
+
+    def slot_content(self, slot, x_offset, y_offset, sheet_height):
+        """ Returns the PDF operators that draw a piece of text on a card at
+        the given offset on the sheet
+        """
+        # Pillow turns a text box anticlockwise about its centre and grows it
+        # to fit, so the text is laid out in the box's own pixels (y down)
+        # and one matrix maps those on to the page
+        width, height = rotated_size(slot.width, slot.height, slot.rotation)
+        angle = math.radians(slot.rotation)
+        cos = math.cos(angle) * self.scale
+        sin = math.sin(angle) * self.scale
+        centre_x = x_offset + slot.x + width / 2
+        centre_y = y_offset + slot.y + height / 2
+        matrix = [
+            cos, sin, sin, -cos,
+            centre_x * self.scale - cos * slot.width / 2
+            - sin * slot.height / 2,
+            (sheet_height - centre_y) * self.scale - sin * slot.width / 2
+            + cos * slot.height / 2]
+        ascent = slot.font.getmetrics()[0]
+        content = [
+            'q {} cm 0 0 {} {} re W n BT /{} {} Tf {} rg'.format(
+                ' '.join(pdf_number(value) for value in matrix),
+                slot.width, slot.height,
+                self.font(slot.font), slot.font.size,
+                ' '.join(pdf_number(value / 255) for value in slot.rgb)
+                ).encode('ascii')]
+        for x_coord, y_coord, line in TEXT.layout(
+                slot.text, slot.width, slot.font, slot.multiline):
+            # Flips the text back up the right way at the line's baseline
+            content.append('1 0 0 -1 {} {} Tm '.format(
+                pdf_number(x_coord),
+                pdf_number(y_coord + ascent)).encode('ascii')
+                           + pdf_string(line) + b' Tj')
+        content.append(b'ET Q')
+        return b'\n'.join(content)
+
+    def close(self):
+        """ Finishes the current file, if there is one, and renames it to its
+        final name
+        """
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.path + '.part', self.path)
+            print('Saved {} pages'.format(self.page_count))
+            self.writer = None
+
+
+class PdfSpooler:
+    """ Puts JPEGs into numbered PDFs, one page each, in the order they're
+    added. The JPEGs are copied straight into the PDFs one at a time, so memory
+    use doesn't depend on how many pages go in each file. A new file is started
+    once one reaches max_pages pages or max_bytes bytes, but only between an
+    address side and its calendar side so duplex printing lines up.
+
+    Each file is written as N-output.pdf.part and only renamed to
+    N-output.pdf once it's full, so a file with its final name is always
+    complete and can be printed while the rest of the batch is rendered.
+    """
+
+    def __init__(self, max_pages=150, max_bytes=None):
+        """ Sets when to start a new file
+        """
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.file_count = 0
+        self.image_count = 0
+        self.writer = None
+        self.path = None
+
+    def start_file(self):
+        """ Opens the next numbered output file under its temporary name
+        """
+        self.file_count += 1
+        self.path = './{}-output.pdf'.format(self.file_count)
+        self.writer = PdfWriter(self.path + '.part')
+
+    def add_image(self, path):
+        """ Adds a JPEG as the next page, and publishes the file if it's full
+        """
+        if self.writer is None:
+            self.start_file()
+        # Resolution is not a percentage, but the DPI values
+        self.writer.add_jpeg_page(path, dpi=300)
+        self.image_count += 1
+        pages = len(self.writer.pages)
+        if pages % 2 == 0 and (
+                pages >= self.max_pages
+                or (self.max_bytes is not None
+                    and self.writer.size >= self.max_bytes)):
+            self.close()
+
+    @METRICS.timed('pdf')
+    def add_sheet(self, paths):
+        """ Adds the address side and the calendar side of a sheet as soon as
+        they're saved
+        """
+        for path in paths:
+            self.add_image(path)
+
+    def close(self):
+        """ Finishes the current file, if there is one, and renames it to its
+        final name
+        """
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.path + '.part', self.path)
+            print('Saved {} images'.format(self.image_count))
+            self.writer = None
+
+
+@METRICS.timed('card')
+def build_cards(uprn_list, records):
+    """ Builds the four address cards and four calendar cards for a list of
+    four UPRNs, with the calendars in the order they go on their side
+    """
+    calendar_images = []
+    address_images = []
+    # Order needs to be swapped around on the calendar side for printing
+    swapped_list = [uprn_list[1], uprn_list[0], uprn_list[3], uprn_list[2]]
+    for number, uprn in enumerate(uprn_list, 1):
+        if uprn is None:
+            address_images.append(None)
+            continue
+        address = Address(records, uprn)
+        address_image = AddressImage(address, number)
+        address_images.append(address_image)
+    for number, uprn in enumerate(swapped_list, 1):
+        if uprn is None:
+            calendar_images.append(None)
+            continue
+        calendar = Calendar(records, uprn)
+        calendar_image = CalendarImage(calendar, number)
+        calendar_images.append(calendar_image)
+    return address_images, calendar_images
+
+def render_sheet(uprn_list, records, writer=None):
+    """ Renders the address side and calendar side for a list of four UPRNs and
+    returns the paths of the two saved images. If a pool of writer threads is
+    given, the sides are saved by it and futures of the paths are returned
+    instead, so the next sheet can be drawn while they're encoded.
+    """
+    address_images, calendar_images = build_cards(uprn_list, records)
+    address_side = AddressSide(address_images)
+    calendar_side = CalendarSide(calendar_images)
+    if writer is None:
+        return address_side.save(), calendar_side.save()
+    return writer.submit(address_side.save), writer.submit(calendar_side.save)
+
+def vector_sheet(uprn_list, records):
+    """ Returns the template and text slots for each card on the address side
+    and the calendar side of a sheet, in the same order render_sheet() puts
+    them in. Any text the PDF can't show is logged, as it comes out as
+    question marks.
+    """
+    sides = build_cards(uprn_list, records)
+    for cards in sides:
+        for card in cards:
+            if card is None:
+                continue
+            texts = slot_texts(card)
+            for field, text in texts:
+                missing = unprintable_characters(text)
+                if missing:
+                    print('Warning: the {} for UPRN {} has {}, which will '
+                          'print as ?'.format(
+                              field, dict(texts)['uprn'], missing))
+    return tuple(
+        [None if card is None else (card.template, card.slots)
+         for card in cards]
+        for cards in sides)
+
+def render_sheet_task(task, writer=None):
+    """ Renders the sheet for a SheetTask, unless it was done in an earlier run.
+    Any error is returned as a traceback rather than raised so one bad sheet
+    doesn't stop the run. The stage times are returned too, as they're added
+    up in whichever process rendered the sheet, along with whether the sheet
+    was reused.
+    """
+    if task.done is not None:
+        return task.index, task.done, None, METRICS.drain(), True
+    try:
+        paths = render_sheet(task.uprns, task.records, writer)
+    except Exception:
+        return (task.index, None, traceback.format_exc(), METRICS.drain(),
+                False)
+    return task.index, paths, None, METRICS.drain(), False
+
+def wait_for_saves(result):
+    """ Waits for the writer threads to save both sides of a sheet from
+    render_sheet_task(), and returns the result with the paths of the saved
+    images, or with the error if either of them couldn't be saved
+    """
+    index, paths, error, timings, reused = result
+    if error is not None or not isinstance(paths[0], Future):
+        return result
+    try:
+        paths = tuple(future.result() for future in paths)
+    except Exception:
+        return index, None, traceback.format_exc(), timings, reused
+    return index, paths, None, timings, reused
+
+def init_worker(output=None, scale=1):
+    """ Loads the templates and fonts once in each worker process, with the
+    same output settings and scale as the main process
+    """
+    global OUTPUT, ASSETS
+    if output is not None:
+        OUTPUT = output
+    if scale != ASSETS.scale:
+        ASSETS = AssetCache(ASSETS.template_dir, scale)
+    ASSETS.warm_up(FONTS)
+
+def worker_sheet_task(task, output, scale):
+    """ Renders a sheet in a worker process, loading the templates and fonts
+    the first time the process is given one. ProcessPoolExecutor can't run an
+    initializer before Python 3.7, so it's done here instead.
+    """
+    global WORKER_READY
+    if not WORKER_READY:
+        init_worker(output, scale)
+        WORKER_READY = True
+    return render_sheet_task(task)
+
+def start_workers(workers):
+    """ Starts a pool of worker processes. Each one is set up with the same
+    output settings and scale as this process by worker_sheet_task().
+    """
+    return ProcessPoolExecutor(workers)
+
+def render_in_workers(tasks, workers):
+    """ Renders each task's sheet in a pool of worker processes and yields the
+    results in the same order as the tasks. If a worker dies, say killed for
+    using too much memory or crashed inside Pillow, the pool is broken and
+    every sheet still queued on it is lost. The pool is started again and the
+    lost sheets are rendered one at a time, so the one that kills a worker
+    again is failed instead of the run hanging or stopping.
+    """
+    executor = start_workers(workers)
+    pending = deque()
+    tasks = iter(tasks)
+    try:
+        while True:
+            # Only a few sheets per worker are queued at once, so tasks are
+            # read from the source as they're needed
+            for task in tasks:
+                pending.append(
+                    (task, executor.submit(
+                        worker_sheet_task, task, OUTPUT, ASSETS.scale)))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            task, future = pending[0]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                executor.shutdown()
+                executor = start_workers(workers)
+                lost = list(pending)
+                pending.clear()
+                for task, future in lost:
+                    if future.done() and future.exception() is None:
+                        yield future.result()
+                        continue
+                    try:
+                        yield executor.submit(
+                            worker_sheet_task, task, OUTPUT,
+                            ASSETS.scale).result()
+                    except BrokenProcessPool:
+                        yield (task.index, None, 'A worker process stopped '
+                               'while rendering this sheet\n', {}, False)
+                        executor.shutdown()
+                        executor = start_workers(workers)
+                continue
+            pending.popleft()
+            yield result
+    finally:
+        executor.shutdown()
+
+def render_sheets(tasks, workers, writers=0):
+    """ Renders each task's sheet, either in this process or spread over a pool
+    of worker processes, and yields the results in the same order as the tasks.
+    In this process the sides can be saved by a pool of writer threads while
+    the next sheets are drawn. A sheet's result is only yielded once both its
+    images are saved.
+    """
+    if workers > 1:
+        yield from render_in_workers(tasks, workers)
+    elif writers > 0 and OUTPUT.band_height is None:
+        # Sides drawn in bands are drawn as they're saved, and the text caches
+        # can't be shared between threads, so they're saved here instead
+        with ThreadPoolExecutor(writers) as writer:
+            # Each sheet waiting to be saved holds two full size images, so
+            # drawing waits for the oldest once there's one per writer
+            pending = deque()
+            for task in tasks:
+                pending.append(render_sheet_task(task, writer))
+                if len(pending) > writers:
+                    yield wait_for_saves(pending.popleft())
+            while pending:
+                yield wait_for_saves(pending.popleft())
+    else:
+        for task in tasks:
+            yield render_sheet_task(task)
+
+def write_vector_sheets(tasks, vector_pdf):
+    """ Writes each task's sheet into the vector PDFs, and yields the results
+    in the same form as render_sheets(), with the sheet's two pages in place
+    of the paths of its images
+    """
+    for index, uprn_list, records, _ in tasks:
+        try:
+            cards = vector_sheet(uprn_list, records)
+        except Exception:
+            yield index, None, traceback.format_exc(), METRICS.drain(), False
+            continue
+        vector_pdf.add_sheet(*cards)
+        pages = ('page {}'.format(vector_pdf.page_count - 1),
+                 'page {}'.format(vector_pdf.page_count))
+        yield index, pages, None, METRICS.drain(), False
+
+def parse_shard(value):
+    """ Reads a shard given as K/N on the command line as (K, N)
+    """
+    try:
+        shard, shard_count = [int(number) for number in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'shards are given as K/N, such as 1/4, not {}'.format(value))
+    if not 1 <= shard <= shard_count:
+        raise argparse.ArgumentTypeError(
+            'shard {} must be from 1 to {}'.format(shard, shard_count))
+    return shard, shard_count
+
+def parse_args():
+    """ Reads the command line options
+    """
+    parser = argparse.ArgumentParser(
+        description='Generates postcards about bin collection days.')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of processes rendering sheets at once (default: 1)')
+    parser.add_argument(
+        '--writers', type=int, default=None,
+        help='number of threads encoding and saving the images while the '
+             'next sheets are drawn, or 0 to save each sheet before drawing '
+             'the next; only used with --workers 1 (default: 2)')
+    parser.add_argument(
+        '--band-height', type=int, default=None,
+        help='draw each side in bands of this many rows, such as 256, into a '
+             'memory mapped file to save memory, instead of drawing it whole')
+    parser.add_argument(
+        '--pdf-pages', type=int, default=150,
+        help='most pages in each output PDF (default: 150)')
+    parser.add_argument(
+        '--pdf-max-mb', type=float, default=None,
+        help='start a new output PDF once one reaches this many megabytes')
+    parser.add_argument(
+        '--spool-pdf', action='store_true',
+        help='add each sheet to the output PDFs as soon as it is saved and '
+             'rename each PDF from N-output.pdf.part once it is full, so '
+             'printing can start before the batch finishes (vector output '
+             'always does this)')
+    parser.add_argument(
+        '--output', choices=['jpeg', 'vector'], default='jpeg',
+        help='render each sheet to JPEG then put them in PDFs, or write the '
+             'PDFs directly with shared template images and real text '
+             '(default: jpeg)')
+    parser.add_argument(
+        '--uprn-file', default=None,
+        help='read the UPRNs from the first column of a CSV file instead of '
+             'running uprn_query.sql')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='skip sheets that ./out/journal.sqlite says were finished by an '
+             'earlier run of the same batch')
+    parser.add_argument(
+        '--snapshot', default=None,
+        help='read the batch from a snapshot made by export_snapshot.py '
+             'instead of the database')
+    parser.add_argument(
+        '--shard', type=parse_shard, default=None, metavar='K/N',
+        help='render only shard K of N of the batch, given as K/N, into '
+             './out/shard-K-of-N, for merge_shards.py to put in PDFs with the '
+             'other shards')
+    parser.add_argument(
+        '--preflight', action='store_true',
+        help='check the data for the whole batch before rendering, write '
+             'the problems to rejects.csv in the output folder and leave the '
+             'rejected UPRNs out of the run')
+    parser.add_argument(
+        '--preflight-only', action='store_true',
+        help='check the data for the whole batch and write rejects.csv '
+             'without rendering anything')
+    parser.add_argument(
+        '--proof-scale', type=float, default=None,
+        help='render proofs at this fraction of the full resolution, such as '
+             '0.25, into ./proof and a contact sheet PDF, ./proof/proof.pdf')
+    parser.add_argument(
+        '--prefetch', type=int, default=1,
+        help='number of chunks of 250 sheets to load from the database ahead '
+             'of the one being rendered (default: 1)')
+    parser.add_argument(
+        '--db-retries', type=int, default=5,
+        help='times to retry a query on a new connection if the database '
+             'drops, waiting twice as long each time (default: 5)')
+    parser.add_argument(
+        '--progress-interval', type=float, default=30,
+        help='seconds between progress lines, or 0 for none (default: 30)')
+    parser.add_argument(
+        '--metrics-log', default=None,
+        help='append the progress and stage times to this file as JSON lines')
+    parser.add_argument(
+        '--trace-memory', action='store_true',
+        help='trace Python memory allocations with tracemalloc and add them '
+             'to the progress lines, which slows the run down')
+    args = parser.parse_args()
+    if args.band_height is not None and args.band_height < 1:
+        parser.error('--band-height must be at least 1')
+    if args.snapshot is not None and not os.path.isfile(args.snapshot):
+        parser.error('there is no snapshot called {}'.format(args.snapshot))
+    if args.proof_scale is not None:
+        if not 0 < args.proof_scale <= 1:
+            parser.error('--proof-scale must be more than 0 and at most 1')
+        if args.output == 'vector':
+            parser.error('--proof-scale only works with --output jpeg')
+    if args.shard is not None and (
+            args.output == 'vector' or args.proof_scale is not None):
+        parser.error('--shard only works with --output jpeg and no '
+                     '--proof-scale')
+    if args.spool_pdf and (
+            args.shard is not None or args.proof_scale is not None):
+        parser.error('--spool-pdf doesn\'t work with --shard or --proof-scale, '
+                     'which don\'t make the output PDFs')
+    if args.output == 'vector' and (
+            args.workers != 1 or args.writers is not None
+            or args.band_height is not None):
+        parser.error('--output vector writes the PDFs in one process without '
+                     'rendering images, so it doesn\'t work with --workers, '
+                     '--writers or --band-height')
+    if args.writers is None:
+        args.writers = 2
+    return args
 
 if __name__ == '__main__':
-    pyodbc.pooling = False
-    CONN_STRING = ConnectionString()
-    CONN = pyodbc.connect(
-        driver=CONN_STRING.driver,
-        server=CONN_STRING.server,
-        database=CONN_STRING.database,
-        uid=CONN_STRING.uid,
-        pwd=CONN_STRING.pwd)
-    UPRN_LISTS = get_uprns(CONN)
-    for index, uprn_list in enumerate(UPRN_LISTS, 1):
-        calendar_images = []
-        address_images = []
-        # Order needs to be swapped around on the calendar side for printing
-        swapped_list = [uprn_list[1], uprn_list[0], uprn_list[3], uprn_list[2]]
-        for number, uprn in enumerate(uprn_list, 1):
-            address = Address(CONN, uprn)
-            address_image = AddressImage(address, number)
-            address_images.append(address_image)
-        for number, uprn in enumerate(swapped_list, 1):
-            calendar = Calendar(CONN, uprn)
-            calendar_image = CalendarImage(calendar, number)
-            calendar_images.append(calendar_image)
-        address_side = AddressSide(address_images)
-        calendar_side = CalendarSide(calendar_images)
-        print('{}: {}'.format(index, address_side.new_file))
-        print('{}: {}'.format(index, calendar_side.new_file))
-    convert_to_pdf()
-    CONN.close()
+    ARGS = parse_args()
+    if ARGS.snapshot is None:
+        import pyodbc
+        pyodbc.pooling = False
+        CONN_STRING = ConnectionString()
+        # The UPRNs are streamed on their own connection, because SQL Server
+        # won't run another query on a connection with rows still to read,
+        # and the records are loaded on another
+        POOL = ConnectionPool(
+            lambda: connect(CONN_STRING), size=2, retries=ARGS.db_retries)
+    else:
+        QUERIES = SNAPSHOT_QUERIES
+        POOL = ConnectionPool(
+            lambda: connect_snapshot(ARGS.snapshot), size=2,
+            retries=ARGS.db_retries)
+    if ARGS.proof_scale is not None:
+        # Proofs go in their own folder with their own journal, so they never
+        # get mixed up with the images for printing
+        OUTPUT = OutputSettings(
+            './proof', 75, 300 * ARGS.proof_scale, ARGS.band_height)
+        ASSETS = AssetCache(scale=ARGS.proof_scale)
+        os.makedirs(OUTPUT.out_dir, exist_ok=True)
+    if ARGS.shard is not None:
+        OUTPUT = OUTPUT._replace(out_dir=os.path.join(
+            OUTPUT.out_dir, 'shard-{}-of-{}'.format(*ARGS.shard)))
+        os.makedirs(OUTPUT.out_dir, exist_ok=True)
+        # The manifest from an earlier run of the shard is out of date until
+        # this run finishes
+        if os.path.exists(os.path.join(OUTPUT.out_dir, 'shard.json')):
+            os.remove(os.path.join(OUTPUT.out_dir, 'shard.json'))
+    if ARGS.band_height is not None:
+        OUTPUT = OUTPUT._replace(band_height=ARGS.band_height)
+    ASSETS.warm_up(FONTS)
+    if ARGS.preflight or ARGS.preflight_only:
+        PREFLIGHT_START = time.time()
+        REPORT_PATH = os.path.join(OUTPUT.out_dir, 'rejects.csv')
+        if ARGS.uprn_file is None:
+            UPRNS, REJECTS = preflight(
+                iter_uprns(POOL), POOL, REPORT_PATH,
+                vector=ARGS.output == 'vector')
+        else:
+            UPRNS, REJECTS = preflight(
+                read_uprns(ARGS.uprn_file), POOL, REPORT_PATH,
+                vector=ARGS.output == 'vector')
+        REJECTED = set(reject.uprn for reject in REJECTS)
+        print('Checked {} UPRNs in {:.1f}s: {} rejected with {} problem(s), '
+              'see {}'.format(
+                  len(UPRNS) + len(REJECTED), time.time() - PREFLIGHT_START,
+                  len(REJECTED), len(REJECTS), REPORT_PATH))
+        if ARGS.preflight_only:
+            POOL.close()
+            sys.exit(1 if REJECTS else 0)
+        UPRN_COUNT = len(UPRNS)
+        SHEETS = group_sheets(UPRNS)
+    elif ARGS.uprn_file is None:
+        UPRN_COUNT = count_uprns(POOL)
+        SHEETS = get_uprns(POOL)
+    else:
+        UPRN_COUNT = sum(1 for _ in read_uprns(ARGS.uprn_file))
+        SHEETS = group_sheets(read_uprns(ARGS.uprn_file))
+    JOURNAL = RunJournal(
+        os.path.join(OUTPUT.out_dir, 'journal.sqlite'), ARGS.resume)
+    BATCH_SHEETS = math.ceil(UPRN_COUNT / 4)
+    TASKS = sheet_tasks(
+        SHEETS, POOL, JOURNAL, prefetch=ARGS.prefetch, shard=ARGS.shard,
+        reuse=ARGS.output == 'jpeg')
+    MAX_BYTES = (
+        None if ARGS.pdf_max_mb is None else int(ARGS.pdf_max_mb * 1024 * 1024))
+    if ARGS.output == 'vector':
+        VECTOR_PDF = VectorPdf(ARGS.pdf_pages, MAX_BYTES)
+        RESULTS = write_vector_sheets(TASKS, VECTOR_PDF)
+    else:
+        RESULTS = render_sheets(TASKS, ARGS.workers, ARGS.writers)
+    # Sheets finished by an earlier run come through the results too, so the
+    # spooled PDFs always hold the whole batch in order
+    SPOOLER = (
+        PdfSpooler(ARGS.pdf_pages, MAX_BYTES)
+        if ARGS.spool_pdf and ARGS.output == 'jpeg' else None)
+    PROGRESS = ProgressReporter(
+        METRICS,
+        BATCH_SHEETS if ARGS.shard is None
+        else shard_sheet_count(BATCH_SHEETS, *ARGS.shard),
+        ARGS.progress_interval, ARGS.metrics_log, ARGS.trace_memory)
+    START = time.time()
+    SHEET_COUNT = 0
+    LAST_INDEX = 0
+    REUSED_COUNT = 0
+    FAILED = []
+    SHEET_PATHS = []
+    for index, paths, error, timings, reused in RESULTS:
+        METRICS.merge(timings)
+        SHEET_COUNT += 1
+        LAST_INDEX = index
+        if reused:
+            REUSED_COUNT += 1
+        if error is None:
+            if ARGS.output == 'vector':
+                # The pages aren't files, so there's nothing to reuse
+                JOURNAL.finish(index)
+            else:
+                JOURNAL.finish(index, paths)
+                SHEET_PATHS.append((index, paths))
+            if SPOOLER is not None:
+                SPOOLER.add_sheet(paths)
+            print('{}: {}'.format(index, paths[0]))
+            print('{}: {}'.format(index, paths[1]))
+        else:
+            JOURNAL.fail(index, error)
+            FAILED.append(index)
+            print('{}: failed\n{}'.format(index, error))
+        PROGRESS.update(SHEET_COUNT, len(FAILED))
+    JOURNAL.trim(LAST_INDEX)
+    ELAPSED = time.time() - START
+    # Reused sheets take no time, so they'd make the run look faster
+    RENDERED_COUNT = SHEET_COUNT - len(FAILED) - REUSED_COUNT
+    print('Rendered {} sheets in {:.1f}s ({:.2f} sheets/s) with {} worker(s)'.format(
+        RENDERED_COUNT, ELAPSED, RENDERED_COUNT / max(ELAPSED, 1e-9),
+        ARGS.workers))
+    if REUSED_COUNT:
+        print('Reused {} sheets from an earlier run'.format(REUSED_COUNT))
+    if FAILED:
+        print('Failed sheets: {}'.format(', '.join(str(i) for i in FAILED)))
+        print('{} UPRNs weren\'t printed, run get_lost_uprns.py to list '
+              'them'.format(len(JOURNAL.missing_uprns())))
+    # The caches live in the worker processes when there's a pool
+    if ARGS.workers == 1:
+        print(ASSETS.stats())
+        print(TEXT.stats())
+    print(POOL.stats())
+    if ARGS.output == 'vector':
+        VECTOR_PDF.close()
+    elif ARGS.shard is not None:
+        write_shard_manifest(
+            os.path.join(OUTPUT.out_dir, 'shard.json'), ARGS.shard[0],
+            ARGS.shard[1], BATCH_SHEETS, SHEET_PATHS, FAILED)
+        print('Finished shard {} of {}, run merge_shards.py once every shard '
+              'has finished'.format(*ARGS.shard))
+    elif ARGS.proof_scale is not None:
+        write_contact_sheet(
+            SHEET_PATHS, os.path.join(OUTPUT.out_dir, 'proof.pdf'))
+    elif SPOOLER is not None:
+        SPOOLER.close()
+    else:
+        convert_to_pdf(ARGS.pdf_pages, MAX_BYTES, [
+            path for _, paths in SHEET_PATHS for path in paths])
+    print(METRICS.format())
+    PROGRESS.close()
+    JOURNAL.close()
+    POOL.close()
@@ -0,0 +1,45 @@
+r"""
+Puts the images from every shard of a batch rendered with
+`generate_multi_image.py --shard K/N` into PDFs, in the same order and split
+into files the same way as a run of the whole batch.
+
+With no arguments it merges the shard folders in ./out. Shards rendered on
+other machines can be copied anywhere and their folders given instead:
+
+    python .\merge_shards.py .\out\shard-1-of-3 \\pc2\out\shard-2-of-3 ...
+
+NOTE:
+    Every shard has to have read the same batch, so don't change the data
+    while the shards are running.
+"""
+
+import argparse
+import glob
+import sys
+
+from generate_multi_image import convert_to_pdf, merge_shards
+
+parser = argparse.ArgumentParser(
+    description='Puts the images from every shard of a batch into PDFs.')
+parser.add_argument(
+    'shard_dirs', nargs='*',
+    help='the shard folders (default: ./out/shard-*)')
+parser.add_argument(
+    '--pdf-pages', type=int, default=150,
+    help='most pages in each output PDF (default: 150)')
+parser.add_argument(
+    '--pdf-max-mb', type=float, default=None,
+    help='start a new output PDF once one reaches this many megabytes')
+args = parser.parse_args()
+shard_dirs = args.shard_dirs or sorted(glob.glob('./out/shard-*'))
+try:
+    paths, missing = merge_shards(shard_dirs)
+except ValueError as error:
+    sys.exit('Can\'t merge the shards: {}'.format(error))
+if missing:
+    print('Sheets not rendered: {}'.format(
+        ', '.join(str(index) for index in missing)))
+convert_to_pdf(
+    args.pdf_pages,
+    None if args.pdf_max_mb is None else int(args.pdf_max_mb * 1024 * 1024),
+    paths)
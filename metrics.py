@@ -0,0 +1,288 @@
+""" metrics.py
+
+Times the stages of a run and reports how it's getting on. Stage timers add
+up the time spent in and the number of calls to each stage in the process
+they run in, so a worker process hands its totals back with each sheet it
+renders. Stages can be nested, so a stage's time includes any stages it
+calls.
+
+The progress reporter prints a line with the throughput and the estimated
+time left at a fixed interval from a background thread, so the line keeps
+coming even if the run is stuck, and can write the same figures to a JSON
+lines file to be graphed after the run.
+"""
+
+import ctypes
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+if sys.platform == 'win32':
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        """ The PROCESS_MEMORY_COUNTERS structure GetProcessMemoryInfo fills in
+        """
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    GetCurrentProcess = ctypes.windll.kernel32.GetCurrentProcess
+    GetCurrentProcess.restype = wintypes.HANDLE
+    GetProcessMemoryInfo = ctypes.windll.psapi.GetProcessMemoryInfo
+    GetProcessMemoryInfo.argtypes = [
+        wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters),
+        wintypes.DWORD]
+    GetProcessMemoryInfo.restype = wintypes.BOOL
+else:
+    GetProcessMemoryInfo = None
+
+
+class Metrics:
+    """ Adds up the time spent in each stage of the pipeline. Stages can be
+    timed from more than one thread.
+    """
+
+    def __init__(self):
+        """ Starts with no stages timed
+        """
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, calls=1):
+        """ Adds some time to a stage
+        """
+        with self.lock:
+            total = self.totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += calls
+
+    def stage(self, name):
+        """ Returns a context manager that times the code inside it as a stage
+        """
+        return StageTimer(self, name)
+
+    def timed(self, name):
+        """ Decorates a function so every call to it is timed as a stage
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with StageTimer(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def merge(self, totals):
+        """ Adds the totals from another process, as returned by drain()
+        """
+        for name, (seconds, calls) in totals.items():
+            self.add(name, seconds, calls)
+
+    def drain(self):
+        """ Returns the totals so far as a dictionary that can be sent between
+        processes, and starts again from zero
+        """
+        with self.lock:
+            totals = {name: tuple(total)
+                      for name, total in self.totals.items()}
+            self.totals = {}
+        return totals
+
+    def summary(self):
+        """ Returns the totals as a dictionary of stage names to seconds and
+        number of calls
+        """
+        with self.lock:
+            totals = sorted(
+                (name, tuple(total)) for name, total in self.totals.items())
+        return {name: {'seconds': round(seconds, 3), 'calls': calls}
+                for name, (seconds, calls) in totals}
+
+    def format(self):
+        """ Returns the totals as a string for logging
+        """
+        return 'Stage times: ' + ', '.join(
+            '{} {:.1f}s/{}'.format(name, stage['seconds'], stage['calls'])
+            for name, stage in self.summary().items())
+
+
+class StageTimer:
+    """ Times the code in a with block and adds it to a stage
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def memory_sample():
+    """ Returns the memory used by this process in megabytes, as much as can be
+    measured on this platform, along with the traced Python allocations if
+    tracemalloc is running
+    """
+    sample = {}
+    if GetProcessMemoryInfo is not None:
+        # The working set is what Windows calls the resident set
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if GetProcessMemoryInfo(
+                GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            sample['rss_mb'] = round(
+                counters.WorkingSetSize / (1024 * 1024), 1)
+            sample['peak_rss_mb'] = round(
+                counters.PeakWorkingSetSize / (1024 * 1024), 1)
+    try:
+        with open('/proc/self/statm') as statm_file:
+            pages = int(statm_file.read().split()[1])
+        sample['rss_mb'] = round(
+            pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes and macOS reports bytes
+        if sys.platform == 'darwin':
+            peak //= 1024
+        sample['peak_rss_mb'] = round(peak / 1024, 1)
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        sample['traced_mb'] = round(current / (1024 * 1024), 1)
+        sample['traced_peak_mb'] = round(peak / (1024 * 1024), 1)
+    return sample
+
+def format_duration(seconds):
+    """ Formats a number of seconds as hours, minutes and seconds
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+    return '{}m{:02d}s'.format(minutes, seconds)
+
+
+class ProgressReporter:
+    """ Prints how far through the run is every few seconds, and writes the
+    same figures to a JSON lines log if there is one
+    """
+
+    def __init__(self, metrics, total=None, interval=30, log_path=None,
+                 trace_memory=False):
+        """ Opens the log and starts the reporting thread. total is the number
+        of sheets in the run, or None if it isn't known. An interval of 0
+        turns off the progress lines but still logs the final figures.
+        """
+        self.metrics = metrics
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.failed = 0
+        self.start = time.time()
+        self.last_sheet = self.start
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.log = None
+        if log_path is not None:
+            self.log = open(log_path, 'a')
+        if trace_memory:
+            tracemalloc.start()
+        self.thread = None
+        if interval:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def update(self, count, failed=0):
+        """ Records how many sheets have been finished so far
+        """
+        self.count = count
+        self.failed = failed
+        self.last_sheet = time.time()
+
+    def run(self):
+        """ Reports the progress until the run is finished
+        """
+        while not self.stopped.wait(self.interval):
+            self.report('progress')
+
+    def report(self, event):
+        """ Prints a progress line and adds a record to the log
+        """
+        now = time.time()
+        elapsed = now - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0
+        record = {
+            'event': event,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'elapsed': round(elapsed, 1),
+            'sheets': self.count,
+            'failed': self.failed,
+            'total': self.total,
+            'sheets_per_second': round(rate, 3),
+            'eta_seconds': None,
+            'since_last_sheet': round(now - self.last_sheet, 1)}
+        if self.total is not None and rate > 0:
+            record['eta_seconds'] = round(
+                max(self.total - self.count, 0) / rate, 1)
+        record.update(memory_sample())
+        record['stages'] = self.metrics.summary()
+        line = 'Progress: {} sheets'.format(self.count)
+        if self.total:
+            line = 'Progress: {}/{} sheets ({:.1f}%)'.format(
+                self.count, self.total, self.count * 100 / self.total)
+        line += ', {:.2f} sheets/s'.format(rate)
+        if record['eta_seconds'] is not None:
+            line += ', ETA {}'.format(format_duration(record['eta_seconds']))
+        line += ', last sheet {:.0f}s ago'.format(record['since_last_sheet'])
+        if 'rss_mb' in record:
+            line += ', RSS {:.0f} MB'.format(record['rss_mb'])
+        if 'traced_mb' in record:
+            line += ', traced {:.0f} MB (peak {:.0f} MB)'.format(
+                record['traced_mb'], record['traced_peak_mb'])
+        with self.lock:
+            if event == 'progress':
+                print(line, flush=True)
+            if self.log is not None:
+                self.log.write(json.dumps(record) + '\n')
+                self.log.flush()
+
+    def close(self):
+        """ Stops the reporting thread, logs the final figures and closes the
+        log
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report('finish')
+        if self.log is not None:
+            self.log.close()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+# The stage totals for this process
+METRICS = Metrics()
@@ -0,0 +1,297 @@
+""" pdf_writer.py
+
+Writes PDFs one page at a time, so only the page being added is ever held in
+memory. JPEG images are copied into the PDF byte for byte, because PDF's
+DCTDecode filter is the JPEG format, so nothing is decoded or re-encoded.
+"""
+
+import os
+import shutil
+
+# JPEG start-of-frame markers, which hold the size of the image
+SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+COLOUR_SPACES = {1: b'/DeviceGray', 3: b'/DeviceRGB', 4: b'/DeviceCMYK'}
+
+
+def read_jpeg_header(path):
+    """ Reads the width, height, number of colour components and whether it's
+    an Adobe JPEG from the markers at the start of a JPEG file, without
+    decoding the image
+    """
+    adobe = False
+    with open(path, 'rb') as jpeg_file:
+        if jpeg_file.read(2) != b'\xff\xd8':
+            raise ValueError('{} is not a JPEG'.format(path))
+        while True:
+            marker = jpeg_file.read(2)
+            while marker[1:] == b'\xff':
+                # Markers can be padded with any number of 0xFF bytes
+                marker = marker[1:] + jpeg_file.read(1)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                raise ValueError('No frame header found in {}'.format(path))
+            length = int.from_bytes(jpeg_file.read(2), 'big')
+            segment = jpeg_file.read(length - 2)
+            if marker[1] == 0xEE and segment.startswith(b'Adobe'):
+                adobe = True
+            if marker[1] in SOF_MARKERS:
+                height = int.from_bytes(segment[1:3], 'big')
+                width = int.from_bytes(segment[3:5], 'big')
+                return width, height, segment[5], adobe
+
+
+def read_png_header(path):
+    """ Reads the width, height, bit depth, colour type and interlace method
+    of a PNG file from its header
+    """
+    with open(path, 'rb') as png_file:
+        if png_file.read(8) != b'\x89PNG\r\n\x1a\n':
+            raise ValueError('{} is not a PNG'.format(path))
+        header = png_file.read(25)
+    if header[4:8] != b'IHDR':
+        raise ValueError('No image header found in {}'.format(path))
+    width = int.from_bytes(header[8:12], 'big')
+    height = int.from_bytes(header[12:16], 'big')
+    return width, height, header[16], header[17], header[20]
+
+
+def read_image_size(path):
+    """ Reads the width and height of a JPEG or PNG file without decoding it
+    """
+    with open(path, 'rb') as image_file:
+        signature = image_file.read(8)
+    if signature.startswith(b'\x89PNG'):
+        return read_png_header(path)[:2]
+    return read_jpeg_header(path)[:2]
+
+
+def pdf_number(value):
+    """ Formats a number for a PDF, without a trailing .0 on whole numbers
+    """
+    if value == int(value):
+        return str(int(value))
+    return '{:.4f}'.format(value).rstrip('0')
+
+
+def pdf_string(text):
+    """ Encodes some text as a PDF string in the WinAnsi character set
+    """
+    data = text.encode('cp1252', errors='replace')
+    for char in (b'\\', b'(', b')'):
+        data = data.replace(char, b'\\' + char)
+    return b'(' + data + b')'
+
+
+class PdfWriter:
+    """ Writes a PDF file object by object, keeping only the byte offsets of
+    the objects in memory so the cross-reference table can be written at the
+    end
+    """
+
+    def __init__(self, path):
+        """ Opens the file and writes the header
+        """
+        self.path = path
+        self.file = open(path, 'wb')
+        self.offsets = {}
+        self.next_number = 1
+        self.pages = []
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        # The page tree has to be written last, once every page is known
+        self.pages_number = self.reserve()
+
+    @property
+    def size(self):
+        """ The number of bytes written so far
+        """
+        return self.file.tell()
+
+    def reserve(self):
+        """ Reserves an object number for an object that's written later
+        """
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    def write_object(self, number, body):
+        """ Writes the body of an object under a reserved number
+        """
+        self.offsets[number] = self.file.tell()
+        self.file.write('{} 0 obj\n'.format(number).encode('ascii'))
+        self.file.write(body)
+        self.file.write(b'\nendobj\n')
+
+    def add_object(self, body):
+        """ Writes an object and returns its number
+        """
+        number = self.reserve()
+        self.write_object(number, body)
+        return number
+
+    def add_stream(self, dictionary, data):
+        """ Writes a stream object from some bytes and returns its number
+        """
+        number = self.reserve()
+        self.offsets[number] = self.file.tell()
+        self.file.write('{} 0 obj\n<< {} /Length {} >>\nstream\n'.format(
+            number, dictionary, len(data)).encode('ascii'))
+        self.file.write(data)
+        self.file.write(b'\nendstream\nendobj\n')
+        return number
+
+    def add_jpeg(self, path):
+        """ Copies a JPEG file into the PDF as an image and returns its number
+        """
+        width, height, components, adobe = read_jpeg_header(path)
+        dictionary = (
+            '/Type /XObject /Subtype /Image /Width {} /Height {} '
+            '/ColorSpace {} /BitsPerComponent 8 /Filter /DCTDecode').format(
+                width, height, COLOUR_SPACES[components].decode('ascii'))
+        if components == 4 and adobe:
+            # Adobe writes CMYK JPEGs with the channels inverted
+            dictionary += ' /Decode [1 0 1 0 1 0 1 0]'
+        number = self.reserve()
+        self.offsets[number] = self.file.tell()
+        self.file.write('{} 0 obj\n<< {} /Length {} >>\nstream\n'.format(
+            number, dictionary, os.path.getsize(path)).encode('ascii'))
+        with open(path, 'rb') as jpeg_file:
+            shutil.copyfileobj(jpeg_file, self.file)
+        self.file.write(b'\nendstream\nendobj\n')
+        return number
+
+    def add_png(self, path):
+        """ Copies the compressed data of a PNG file into the PDF as an image
+        and returns its number. PDF understands PNG's row filters, so the
+        pixels aren't decoded.
+        """
+        width, height, bit_depth, colour_type, interlace = read_png_header(path)
+        # Only greyscale and RGB without transparency can be copied directly
+        components = {0: 1, 2: 3}.get(colour_type)
+        if components is None or bit_depth != 8 or interlace:
+            raise ValueError('{} must be an 8-bit, non-interlaced RGB or '
+                             'greyscale PNG'.format(path))
+        length = 0
+        with open(path, 'rb') as png_file:
+            png_file.seek(8)
+            while True:
+                chunk_length = int.from_bytes(png_file.read(4), 'big')
+                chunk_type = png_file.read(4)
+                if chunk_type == b'IDAT':
+                    length += chunk_length
+                elif chunk_type in (b'IEND', b''):
+                    break
+                png_file.seek(chunk_length + 4, 1)
+        dictionary = (
+            '/Type /XObject /Subtype /Image /Width {0} /Height {1} '
+            '/ColorSpace {2} /BitsPerComponent 8 /Filter /FlateDecode '
+            '/DecodeParms << /Predictor 15 /Colors {3} /Columns {0} >>').format(
+                width, height, COLOUR_SPACES[components].decode('ascii'),
+                components)
+        number = self.reserve()
+        self.offsets[number] = self.file.tell()
+        self.file.write('{} 0 obj\n<< {} /Length {} >>\nstream\n'.format(
+            number, dictionary, length).encode('ascii'))
+        # The image data is split over any number of IDAT chunks
+        with open(path, 'rb') as png_file:
+            png_file.seek(8)
+            while True:
+                chunk_length = int.from_bytes(png_file.read(4), 'big')
+                chunk_type = png_file.read(4)
+                if chunk_type == b'IDAT':
+                    self.file.write(png_file.read(chunk_length))
+                    png_file.seek(4, 1)
+                elif chunk_type in (b'IEND', b''):
+                    break
+                else:
+                    png_file.seek(chunk_length + 4, 1)
+        self.file.write(b'\nendstream\nendobj\n')
+        return number
+
+    def add_image(self, path):
+        """ Copies a JPEG or PNG file into the PDF as an image and returns its
+        number. The templates are PNGs, whatever their file extension says.
+        """
+        with open(path, 'rb') as image_file:
+            signature = image_file.read(8)
+        if signature.startswith(b'\x89PNG'):
+            return self.add_png(path)
+        return self.add_jpeg(path)
+
+    def add_truetype_font(self, path, name, first_char, widths, ascent,
+                          descent, cap_height, italic_angle=0):
+        """ Embeds a TrueType font file as a WinAnsi encoded font and returns
+        the number of the font object. Widths and other metrics are in
+        thousandths of the font size, starting at first_char.
+        """
+        with open(path, 'rb') as font_file:
+            data = font_file.read()
+        font_file = self.add_stream('/Length1 {}'.format(len(data)), data)
+        # Flags: 32 is a non-symbolic font, 64 is italic
+        flags = 32 | (64 if italic_angle else 0)
+        descriptor = self.add_object((
+            '<< /Type /FontDescriptor /FontName /{} /Flags {} '
+            '/FontBBox [0 {} {} {}] /ItalicAngle {} /Ascent {} /Descent {} '
+            '/CapHeight {} /StemV 80 /FontFile2 {} 0 R >>').format(
+                name, flags, -descent, max(widths), ascent,
+                pdf_number(italic_angle), ascent, -descent, cap_height,
+                font_file).encode('ascii'))
+        return self.add_object((
+            '<< /Type /Font /Subtype /TrueType /BaseFont /{} /FirstChar {} '
+            '/LastChar {} /Widths [{}] /Encoding /WinAnsiEncoding '
+            '/FontDescriptor {} 0 R >>').format(
+                name, first_char, first_char + len(widths) - 1,
+                ' '.join(str(width) for width in widths),
+                descriptor).encode('ascii'))
+
+    def add_page(self, width, height, content, xobjects=None, fonts=None):
+        """ Adds a page of the given size in points. xobjects and fonts map
+        the resource names used in the content stream to object numbers.
+        """
+        resources = []
+        for key, names in ((b'/XObject', xobjects), (b'/Font', fonts)):
+            if names:
+                resources.append(key + b' << ' + b' '.join(
+                    '/{} {} 0 R'.format(name, number).encode('ascii')
+                    for name, number in sorted(names.items())) + b' >>')
+        contents = self.add_stream('', content)
+        self.pages.append(self.add_object(
+            ('<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] '
+             '/Contents {} 0 R /Resources << ').format(
+                 self.pages_number, pdf_number(width), pdf_number(height),
+                 contents).encode('ascii')
+            + b' '.join(resources) + b' >> >>'))
+
+    def add_jpeg_page(self, path, dpi=300):
+        """ Adds a page holding a single JPEG, sized for printing at the given
+        resolution
+        """
+        width, height = read_jpeg_header(path)[:2]
+        width = width * 72 / dpi
+        height = height * 72 / dpi
+        image = self.add_jpeg(path)
+        content = 'q {} 0 0 {} 0 0 cm /Im0 Do Q'.format(
+            pdf_number(width), pdf_number(height)).encode('ascii')
+        self.add_page(width, height, content, xobjects={'Im0': image})
+
+    def close(self):
+        """ Writes the page tree, catalogue and cross-reference table and
+        closes the file
+        """
+        self.write_object(self.pages_number, (
+            '<< /Type /Pages /Count {} /Kids [{}] >>'.format(
+                len(self.pages),
+                ' '.join('{} 0 R'.format(page) for page in self.pages))
+            ).encode('ascii'))
+        catalog = self.add_object('<< /Type /Catalog /Pages {} 0 R >>'.format(
+            self.pages_number).encode('ascii'))
+        xref_offset = self.file.tell()
+        self.file.write('xref\n0 {}\n'.format(self.next_number).encode('ascii'))
+        self.file.write(b'0000000000 65535 f \n')
+        for number in range(1, self.next_number):
+            self.file.write('{:010d} 00000 n \n'.format(
+                self.offsets[number]).encode('ascii'))
+        self.file.write((
+            'trailer\n<< /Size {} /Root {} 0 R >>\nstartxref\n{}\n%%EOF\n'
+            ).format(self.next_number, catalog, xref_offset).encode('ascii'))
+        self.file.close()
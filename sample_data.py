@@ -0,0 +1,253 @@
+""" sample_data.py
+
+Builds a SQLite database with the same tables and columns that
+uprn_query.sql and cal_query.sql read, filled with a synthetic batch of
+addresses and collection rounds. It stands in for the LLPG database so the
+render pipeline can be run and timed anywhere, and the same seed always gives
+the same batch. FlakyConnection wraps a connection so queries fail now and
+then, to check that dropped connections are retried.
+
+    python .\sample_data.py sample.sqlite --count 5000
+"""
+
+import argparse
+import random
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE properties (uprn TEXT PRIMARY KEY);
+CREATE TABLE LLPG_ADDRESS_CURRENT_SPATIAL (
+    uprn TEXT PRIMARY KEY,
+    ADDRESS_BLOCK_ORG TEXT);
+CREATE TABLE PropertyServiceRounds (
+    uprn TEXT,
+    serviceid TEXT,
+    RoundEra INTEGER,
+    RoundID INTEGER);
+CREATE INDEX psr_uprn ON PropertyServiceRounds (uprn, serviceid);
+CREATE TABLE rounds (
+    RoundID INTEGER PRIMARY KEY,
+    serviceid TEXT,
+    RoundEra INTEGER,
+    ScheduleDayID INTEGER);
+CREATE TABLE comms_batches (uprn TEXT, batch INTEGER, exclude INTEGER);
+"""
+
+# ScheduleDayID is Monday to Friday as 1-5 in the first week and 8-12 in the
+# second
+SCHEDULE_DAYS = [1, 2, 3, 4, 5, 8, 9, 10, 11, 12]
+SERVICES = ['REF', 'RECY', 'GW']
+STREETS = [
+    'High Street', 'Church Lane', 'Station Road', 'Mill Lane', 'Main Street',
+    'Westgate', 'Back Lane', 'Chapel Street', 'The Green', 'Park Avenue',
+    'Moor Lane', 'Springfield Close', 'Beech Grove', 'Orchard Way',
+    'Manor Road', 'Victoria Terrace', 'Kirkgate', 'Bondgate']
+TOWNS = [
+    ('Selby', 'YO8'), ('Tadcaster', 'LS24'), ('Sherburn in Elmet', 'LS25'),
+    ('Riccall', 'YO19'), ('Barlby', 'YO8'), ('Brayton', 'YO8'),
+    ('Carlton', 'DN14'), ('Hambleton', 'YO8')]
+
+
+def round_id(service, day):
+    """ The RoundID of the round for a service on a schedule day
+    """
+    return SERVICES.index(service) * 100 + day
+
+def make_schedules(rand, count):
+    """ Makes a number of distinct collection schedules as (refuse, recycling,
+    garden waste) schedule days. Recycling is mostly collected the week
+    opposite refuse, and some schedules have no garden waste collection.
+    """
+    schedules = set()
+    while len(schedules) < count:
+        ref = rand.choice(SCHEDULE_DAYS)
+        if rand.random() < 0.8:
+            recy = ref + 7 if ref < 8 else ref - 7
+        else:
+            recy = rand.choice(SCHEDULE_DAYS)
+        gw = None if rand.random() < 0.2 else rand.choice(SCHEDULE_DAYS)
+        schedules.add((ref, recy, gw))
+    return sorted(schedules, key=lambda schedule: (
+        schedule[0], schedule[1], schedule[2] or 0))
+
+def make_address(rand, number, street, town, postcode):
+    """ Makes an address block in the same layout as ADDRESS_BLOCK_ORG, with
+    Windows line breaks and the county on its own line
+    """
+    lines = []
+    if rand.random() < 0.1:
+        lines.append('Flat {}'.format(rand.randint(1, 12)))
+    if rand.random() < 0.05:
+        lines.append('{} House'.format(rand.choice(
+            ['Rose', 'Ivy', 'Holly', 'Ash', 'Meadow'])))
+    lines.append('{} {}'.format(number, street))
+    lines.append(town)
+    lines.append('North Yorkshire')
+    lines.append('{} {}{}'.format(
+        postcode, rand.randint(1, 9),
+        ''.join(rand.choice('ABDEFGHJLNPQRSTUWXYZ') for _ in range(2))))
+    return '\r\n'.join(lines)
+
+def create_sample_database(path=':memory:', count=1000, seed=0, schedules=36,
+                           batch=4):
+    """ Creates a database holding count properties in the given batch and
+    returns a connection to it. Houses on the same street mostly share a
+    schedule, so there are only a few dozen distinct calendars, as in the real
+    data. A few properties are left out of the batch or can't be printed, so
+    uprn_query.sql has something to filter.
+    """
+    rand = random.Random(seed)
+    # Connections are shared between threads by the connection pool
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.executescript(SCHEMA)
+    for service in SERVICES:
+        connection.executemany(
+            'INSERT INTO rounds VALUES (?, ?, 2, ?)',
+            [(round_id(service, day), service, day) for day in SCHEDULE_DAYS])
+    schedule_list = make_schedules(rand, schedules)
+    properties = []
+    addresses = []
+    service_rounds = []
+    batch_rows = []
+    uprn_number = 10000000000
+    while len(properties) < count:
+        street = rand.choice(STREETS)
+        town, postcode = rand.choice(TOWNS)
+        schedule = rand.choice(schedule_list)
+        for number in range(1, rand.randint(4, 60)):
+            if len(properties) == count:
+                break
+            uprn_number += rand.randint(1, 40)
+            uprn = '{:012d}'.format(uprn_number)
+            properties.append((uprn,))
+            addresses.append((uprn, make_address(
+                rand, number, street, town, postcode)))
+            if rand.random() < 0.05:
+                # A house on a different round to the rest of its street
+                days = rand.choice(schedule_list)
+            else:
+                days = schedule
+            for service, day in zip(SERVICES, days):
+                if day is not None:
+                    service_rounds.append(
+                        (uprn, service, round_id(service, day)))
+            batch_rows.append((
+                uprn, batch if rand.random() < 0.98 else batch + 1,
+                1 if rand.random() < 0.01 else 0))
+    connection.executemany('INSERT INTO properties VALUES (?)', properties)
+    connection.executemany(
+        'INSERT INTO LLPG_ADDRESS_CURRENT_SPATIAL VALUES (?, ?)', addresses)
+    connection.executemany(
+        'INSERT INTO PropertyServiceRounds VALUES (?, ?, 2, ?)',
+        service_rounds)
+    connection.executemany(
+        'INSERT INTO comms_batches VALUES (?, ?, ?)', batch_rows)
+    connection.commit()
+    attach(connection, path)
+    if path == ':memory:':
+        # An attached in-memory database starts out empty
+        connection.execute(
+            'CREATE TABLE ro.comms_batches AS SELECT * FROM main.comms_batches')
+        connection.commit()
+    return connection
+
+def attach(connection, path):
+    """ Attaches the ro schema that uprn_query.sql reads the batches from. A
+    file database is attached to itself, so it's all kept in the one file.
+    """
+    connection.execute('ATTACH DATABASE ? AS ro', (path,))
+
+def connect_sample_database(path):
+    """ Opens a database made by create_sample_database()
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    attach(connection, path)
+    return connection
+
+
+class FlakyConnection:
+    """ Wraps a database connection so that each query or fetch fails with a
+    given chance, the way a dropped connection to SQL Server does. Once it has
+    failed, everything done with it fails, so it has to be replaced.
+    """
+
+    def __init__(self, connection, failure_rate=0.1, rand=None):
+        """ Sets the chance of each call failing. Pass a shared random.Random
+        to make the failures repeatable.
+        """
+        self.connection = connection
+        self.failure_rate = failure_rate
+        self.rand = rand or random.Random()
+        self.broken = False
+
+    def check(self):
+        """ Raises an error if the connection has dropped, or drops it at
+        random
+        """
+        if not self.broken and self.rand.random() < self.failure_rate:
+            self.broken = True
+        if self.broken:
+            # Worded like a busy SQLite database, so it's retried
+            raise sqlite3.OperationalError(
+                'Injected failure: the database is busy')
+
+    def cursor(self):
+        self.check()
+        return FlakyCursor(self, self.connection.cursor())
+
+    def close(self):
+        self.connection.close()
+
+
+class FlakyCursor:
+    """ A cursor on a FlakyConnection
+    """
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, *args):
+        self.connection.check()
+        self.cursor.execute(*args)
+        return self
+
+    def fetchone(self):
+        self.connection.check()
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        self.connection.check()
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        self.connection.check()
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Creates a SQLite database of synthetic addresses and '
+                    'collection rounds.')
+    PARSER.add_argument('path', help='the database file to create')
+    PARSER.add_argument(
+        '--count', type=int, default=1000,
+        help='number of properties (default: 1000)')
+    PARSER.add_argument(
+        '--seed', type=int, default=0,
+        help='random seed, the same seed gives the same data (default: 0)')
+    PARSER.add_argument(
+        '--schedules', type=int, default=36,
+        help='number of distinct collection schedules (default: 36)')
+    ARGS = PARSER.parse_args()
+    CONN = create_sample_database(
+        ARGS.path, ARGS.count, ARGS.seed, ARGS.schedules)
+    CONN.close()
+    print('Created {} properties in {}'.format(ARGS.count, ARGS.path))
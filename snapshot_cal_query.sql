@@ -0,0 +1,11 @@
+SELECT
+    uprn,
+    addressBlock,
+    REFWeek,
+    REFDay,
+    RECYWeek,
+    RECYDay,
+    GWWeek,
+    GWDay
+FROM records
+WHERE uprn IN ({})
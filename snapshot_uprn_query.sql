@@ -0,0 +1,3 @@
+SELECT uprn
+FROM batch
+ORDER BY seq;
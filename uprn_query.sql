@@ -29,4 +29,5 @@ AND mix.ScheduleDayID IS NULL
 AND glass.ScheduleDayID IS NULL
 AND recy.ScheduleDayID IS NOT NULL
 AND ref.ScheduleDayID IS NOT NULL
-AND b.batch = 4 and b.exclude = 0;
\ No newline at end of file
+AND b.batch = 4 and b.exclude = 0
+ORDER BY p.uprn;
\ No newline at end of file